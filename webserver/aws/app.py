@@ -1,16 +1,13 @@
 import asyncio
-import base64
-from collections.abc import AsyncIterable
 from datetime import datetime
-import time
 from blacksheep import Application, Request, Response, StreamedContent, get, WebSocket, WebSocketDisconnectError, json, post, ws
 from blacksheep.server.compression import GzipMiddleware
-from blacksheep.server.sse import ServerSentEvent
 from blacksheep.server.rendering.jinja2 import JinjaRenderer
 from blacksheep.settings.html import html_settings
 from blacksheep.server.responses import view_async
 import os
 from utils.logger import Log
+from utils.disconnect import cancel_on_disconnect, cancel_on_ws_disconnect
 from constants import HTTP_PORT, HTTPS_PORT, QUIC_PORT, PUBLIC_IP, stream_status, Format
 
 app = Application(show_error_details=True)
@@ -38,9 +35,12 @@ def home(request: Request):
     Receive Video From Raspberry PI
 '''
 from constants import INCOMING_FORMAT, OUTGOING_FORMAT, PROTOCOL_FORMAT
-from constants import frame_queues, INFERENCE_ENABLED
+from constants import frame_hub, rendition_hubs, INFERENCE_ENABLED, WS_BATCH_MAX_FRAMES, WS_BATCH_MAX_BYTES
 from handler import handle_jpg_to_jpg, handle_jpg_to_h264, handle_h264_to_jpg, handle_h264_to_h264, tcp_handle_jpg_to_jpg, tcp_handle_jpg_to_h264, tcp_handle_h264_to_jpg, tcp_handle_h264_to_h264, ctx
 from inference import get_onnx_status
+from utils.rendition import RenditionSubscriber, AUTO
+from utils.wire import WirePayload, text_event, batch_message
+from utils.latency import LatencyReport
 
 @app.after_start
 async def start():
@@ -101,69 +101,84 @@ async def start_stream(request: Request):
 
     return json({"error": False})
 
+@get("/ingest_status")
+async def ingest_status(request: Request):
+    """Gap wait and late / dropped / recovered counters of the UDP frame dispatcher, null over TCP."""
+    dispatcher = ctx.dispatcher
+    return json({"dispatcher": dispatcher.metrics() if dispatcher is not None else None})
+
+@get("/viewer_status")
+async def viewer_status(request: Request):
+    """Published / GOP counters of the viewer hubs and the lag, delivered and skipped counters of every viewer."""
+    return json({
+        "frame_hub": frame_hub.metrics(),
+        "renditions": {name: hub.metrics() for name, hub in rendition_hubs.items()},
+        "viewers": [viewer.metrics() for viewer in RenditionSubscriber.viewers],
+    })
+
 
 ''' 
     ServerSentEvents: Video Stream Endpoints (h264 codec)
 '''
 @get("/h264_stream")
-async def h264_stream(request: Request) -> AsyncIterable[ServerSentEvent]:
-    frame_queue = asyncio.Queue()
-    frame_queues.append(frame_queue)
+async def h264_stream(request: Request):
+    # ?rendition=full|half|low|auto picks the simulcast stream, see ENCODER_RENDITIONS
+    subscriber = RenditionSubscriber(request.query.get('rendition', [AUTO])[0])
+
+    # Events are serialized once per frame (WirePayload.sse) and shared by every viewer.
+    # Sends are paced by the transport, the loop is cancelled when the client disconnects
+    async def event_generator():
+        watcher = cancel_on_disconnect(request)
+        try:
+            while True:
+                try:
+                    # Stale frames are skipped by the hub, up to the newest keyframe
+                    _, payload = await subscriber.get()
 
-    try:
-        while True:
-            if await request.is_disconnected():
-                Log.info("The request is disconnected!")
-                break
-            try:
-                timestamp, packed_data = await frame_queue.get()
-                age = time.time() - timestamp
-                encoded = base64.b64encode(packed_data).decode("ascii")
+                    # Detections (inference metadata mode) are already JSON
+                    if isinstance(payload, str):
+                        yield text_event(payload, "detections")
+                        continue
 
-                if age > 0.2:
-                    Log.warning(f"Skipped old frame ({age:.3f}s old)")
-                    continue
-                yield ServerSentEvent({"message": encoded})
+                    yield payload.sse
+                except asyncio.CancelledError:
+                    break
+                except KeyboardInterrupt:
+                    break
+                except Exception as e:
+                    Log.exception(f"Error in frame generator: {e}")
+        finally:
+            watcher.cancel()
+            subscriber.close()
 
-                await asyncio.sleep(0.005)
-            except asyncio.CancelledError:
-                break
-            except KeyboardInterrupt:
-                break
-            except Exception as e:
-                Log.exception(f"Error in frame generator: {e}")
-    finally:
-        if frame_queue in frame_queues:
-            frame_queues.remove(frame_queue)
+    return Response(
+        200,
+        headers=[(b"Cache-Control", b"no-cache")],
+        content=StreamedContent(
+            content_type=b"text/event-stream",
+            data_provider=event_generator
+        )
+    )
 
 '''
     ServerSentEvents: Video Stream Endpoints (JPG)
 '''
 @get("/jpg_stream")
 async def jpg_stream(request: Request):
-    # Create a queue for the new client and add it to the list of queues
-    frame_queue = asyncio.Queue()
-    frame_queues.append(frame_queue)
+    subscription = frame_hub.subscribe()
 
     async def frame_generator():
+        watcher = cancel_on_disconnect(request)
         try:
             while True:
-                if await request.is_disconnected():
-                    Log.info("The request is disconnected!")
-                    break
-
                 try:
-                    timestamp, frame_bytes = await frame_queue.get()
-                    age = time.time() - timestamp
-                    if age > 0.2:
-                        Log.warning(f"Skipped old frame ({age:.3f}s old)")
+                    # Stale frames are skipped by the hub, every JPEG is a keyframe
+                    _, payload = await subscription.get()
+                    if isinstance(payload, str):
+                        # Detection metadata, MJPEG has no channel for it
                         continue
-                    
-                    yield (
-                        b"--frame\r\n"
-                        b"Content-Type: image/jpeg\r\n\r\n" + frame_bytes + b"\r\n\r\n"
-                    )
-                    await asyncio.sleep(0.005)
+
+                    yield payload.multipart
                 except asyncio.CancelledError:
                     break
                 except KeyboardInterrupt:
@@ -171,8 +186,8 @@ async def jpg_stream(request: Request):
                 except Exception as e:
                     Log.exception(f"Error in frame generator: {e}")
         finally:
-            if frame_queue in frame_queues:
-                frame_queues.remove(frame_queue)
+            watcher.cancel()
+            subscription.close()
 
     return Response(
         200,
@@ -189,8 +204,12 @@ async def jpg_stream(request: Request):
 async def ws_h264_stream(websocket: WebSocket):
     await websocket.accept()
 
-    frame_queue = asyncio.Queue()
-    frame_queues.append(frame_queue)
+    subscriber = RenditionSubscriber(websocket.query.get('rendition', [AUTO])[0])
+    # ?framing=batch: packets go as batch_message, several per message when the socket is backed up,
+    # and the client reports its latency back as text messages
+    batching = websocket.query.get('framing', [''])[0] == 'batch'
+    latency = LatencyReport(f"viewer {id(websocket):x}")
+    watcher = None
 
     try:
         while True:
@@ -199,17 +218,25 @@ async def ws_h264_stream(websocket: WebSocket):
                 Log.info("READY TO RECEIVE")
                 break
             await asyncio.sleep(0.02)
-        while True:
-            try:
-                timestamp, packed_data = await frame_queue.get()
-                age = time.time() - timestamp
 
-                if age > 0.2:
-                    Log.warning(f"Skipped old frame ({age:.3f}s old)")
-                    continue
+        def on_message(message: dict):
+            if message.get("text"):
+                latency.add_message(message["text"])
 
-                await websocket.send_bytes(packed_data)
-                await asyncio.sleep(0.005)
+        # Sends are paced by the transport, the loop is cancelled when the client disconnects
+        watcher = cancel_on_ws_disconnect(websocket, on_message)
+        while True:
+            try:
+                # Stale frames are skipped by the hub, up to the newest keyframe
+                _, payload = await subscriber.get()
+
+                if isinstance(payload, str):
+                    # Detections (inference metadata mode) go as text messages next to the binary frames
+                    await websocket.send_text(payload)
+                elif not batching:
+                    await websocket.send_bytes(payload.data)
+                else:
+                    await send_batch(websocket, subscriber, payload)
             except asyncio.CancelledError:
                 break
             except KeyboardInterrupt:
@@ -219,8 +246,28 @@ async def ws_h264_stream(websocket: WebSocket):
     except WebSocketDisconnectError:
         return
     finally:
-        if frame_queue in frame_queues:
-            frame_queues.remove(frame_queue)
+        if watcher is not None:
+            watcher.cancel()
+        subscriber.close()
+
+async def send_batch(websocket: WebSocket, subscriber: RenditionSubscriber, payload: WirePayload):
+    # Packets that piled up while the previous send was draining go out in the same message
+    batch = [payload]
+    size = len(payload.data)
+    detections = None
+    while len(batch) < WS_BATCH_MAX_FRAMES and size < WS_BATCH_MAX_BYTES:
+        item = subscriber.get_nowait()
+        if item is None:
+            break
+        if isinstance(item[1], str):
+            detections = item[1]
+            break
+        batch.append(item[1])
+        size += len(item[1].data)
+
+    await websocket.send_bytes(batch_message(batch))
+    if detections is not None:
+        await websocket.send_text(detections)
 
 '''
     HTML Content
@@ -1,16 +1,25 @@
 import asyncio
 from enum import Enum
 from multiprocessing import Process
-from typing import List, Optional
+import multiprocessing.queues
+import multiprocessing.synchronize
+from typing import Dict, List, Optional
 from asyncio import DatagramTransport, Queue, Task, Server
-from inference import ShmQueue
+from inference import ShmQueue, ShmByteRing
 from utils.logger import Log
+from utils.packet_queue import KeyframeDropQueue
+from utils.broadcast import BroadcastHub
 from utils.public_ip import get_public_ip
 
-frame_queues: List[Queue] = []
-"""List of asyncio frame queues, one for each connected client on video_stream endpoint"""
+frame_hub: BroadcastHub = BroadcastHub()
+"""Frames / packets fanned out to every connected client on the video stream endpoints"""
 
-decode_queue: Queue  = Queue()
+rendition_hubs: Dict[str, BroadcastHub] = {}
+"""Simulcast rendition name -> hub of that rendition, heaviest first. The first rendition is frame_hub.
+Empty when the outgoing stream has a single rendition"""
+
+decode_queue: KeyframeDropQueue = KeyframeDropQueue(maxsize=30)
+"""H.264 packets waiting for the decoder, drops up to the next keyframe when decoding falls behind"""
 encode_queue: Queue  = Queue()
 jpg_queue: Queue     = Queue()
 ordered_queue: Queue = Queue()
@@ -22,13 +31,22 @@ frame_dispatch_reset = {"value": False}
 class ServerContext:
     def __init__(self):
         self.transport: Optional[DatagramTransport] = None
-        self.infer_process: Optional[Process] = None
+        self.infer_processes: List[Process] = []
         self.input_queue: Optional[ShmQueue] = None
         self.output_queue: Optional[ShmQueue] = None
+        self.detection_queue: Optional[multiprocessing.queues.Queue] = None
+        self.detection_task: Optional[Task] = None
+        self.packet_ring: Optional[ShmByteRing] = None
+        self.decode_process: Optional[Process] = None
+        self.encoded_rings: Dict[str, ShmByteRing] = {}
+        self.encode_process: Optional[Process] = None
+        self.keyframe_request: Optional[multiprocessing.synchronize.Event] = None
+        self.keyframe_requests: Dict[str, multiprocessing.synchronize.Event] = {}  # One per rendition of the encode worker
         self.consumer_task: Optional[Task] = None
         self.encode_task: Optional[Task] = None
         self.decode_task: Optional[Task] = None
         self.ordering_task: Optional[Task] = None
+        self.dispatcher: any = None     # OrderedPacketDispatcher of the UDP ingest, its metrics() are served on /ingest_status
         self.jpg_producer_task: Optional[Task] = None
         self.protocol: any = None
         self.server:Optional[Server] = None
@@ -44,12 +62,29 @@ class ServerContext:
             Log.exception(f"Error at cleanup transport: {e}")
 
         try:
-            if self.infer_process:
-                self.infer_process.kill()
-                self.infer_process.join()
-                self.infer_process = None
+            for infer_process in self.infer_processes:
+                infer_process.kill()
+            for infer_process in self.infer_processes:
+                infer_process.join()
+            self.infer_processes = []
+        except Exception as e:
+            Log.exception(f"Error at cleanup infer_processes: {e}")
+
+        try:
+            if self.decode_process:
+                self.decode_process.kill()
+                self.decode_process.join()
+                self.decode_process = None
         except Exception as e:
-            Log.exception(f"Error at cleanup infer_process: {e}")
+            Log.exception(f"Error at cleanup decode_process: {e}")
+
+        try:
+            if self.encode_process:
+                self.encode_process.kill()
+                self.encode_process.join()
+                self.encode_process = None
+        except Exception as e:
+            Log.exception(f"Error at cleanup encode_process: {e}")
 
         try:
             if self.consumer_task:
@@ -65,6 +100,17 @@ class ServerContext:
         except Exception as e:
             Log.exception(f"Error at cleanup consumer_task: {e}")
 
+        try:
+            if self.detection_task:
+                self.detection_task.cancel()
+                try:
+                    await self.detection_task
+                except asyncio.CancelledError:
+                    pass
+                self.detection_task = None
+        except Exception as e:
+            Log.exception(f"Error at cleanup detection_task: {e}")
+
         try:
             if self.encode_task:
                 self.encode_task.cancel()
@@ -106,9 +152,34 @@ class ServerContext:
                 except asyncio.CancelledError:
                     pass
                 self.ordering_task = None
+                self.dispatcher = None
         except Exception as e:
             Log.exception(f"Error at cleanup ordering_task: {e}")
 
+        try:
+            if self.packet_ring:
+                self.packet_ring.stop()
+                self.packet_ring.cleanup()
+                self.packet_ring = None
+        except Exception as e:
+            Log.exception(f"Error at cleanup packet_ring: {e}")
+
+        try:
+            for encoded_ring in self.encoded_rings.values():
+                encoded_ring.stop()
+                encoded_ring.cleanup()
+            self.encoded_rings = {}
+        except Exception as e:
+            Log.exception(f"Error at cleanup encoded_rings: {e}")
+
+        try:
+            if self.detection_queue:
+                self.detection_queue.cancel_join_thread()
+                self.detection_queue.close()
+                self.detection_queue = None
+        except Exception as e:
+            Log.exception(f"Error at cleanup detection_queue: {e}")
+
         try:
             if self.output_queue:
                 self.output_queue.stop()
@@ -160,6 +231,47 @@ INCOMING_FORMAT  = Format.H264      # Valid: JPG or H264
 OUTGOING_FORMAT  = Format.H264      # Valid: JPG or H264
 PROTOCOL_FORMAT  = 'TCP'           # Valid: UDP or TCP
 INFERENCE_ENABLED = bool(True)
+INFERENCE_MAX_BATCH = 4            # Max frames stacked into one session.run call
+INFERENCE_MAX_WAIT  = 0.010        # Max seconds to wait for a batch to fill up
+INFERENCE_WORKERS   = 1            # Number of ObjectDetection processes pulling from the input queue
+INFERENCE_INTRA_OP_THREADS = 0     # onnxruntime intra op threads per worker, 0 = one per physical core
+INFERENCE_INTER_OP_THREADS = 0     # onnxruntime inter op threads per worker, only used by the parallel execution mode
+INFERENCE_EXECUTION_MODE   = 'sequential'  # Valid: sequential or parallel
+INFERENCE_GRAPH_OPT_LEVEL  = 'all'         # Valid: disable, basic, extended or all
+INFERENCE_MODEL_CACHE      = bool(True)    # Cache the optimized graph next to the model so restarts skip optimization
+INFERENCE_IO_BINDING       = bool(True)    # Run through IO binding with preallocated input / output buffers
+INFERENCE_OUTPUT           = 'metadata'    # Valid: frame (boxes drawn, re-encoded) or metadata (H264 to H264 only, packets untouched + JSON detections)
+INFERENCE_STRIDE           = 1     # Run the model every Nth frame, skipped frames reuse the last detections
+INFERENCE_MOTION_THRESHOLD = 0.0   # Also run the model when the mean gray level difference exceeds this, 0 = off
+INFERENCE_REORDER_WINDOW   = 8     # Max frames held back to restore frame_id order across workers
+INFERENCE_REORDER_DELAY    = 0.1   # Max seconds a frame is held back waiting for a missing frame_id
+SHM_LATENCY_BUDGET  = 1.0          # Seconds of frames each ShmQueue may buffer before it is full
+SHM_QUEUE_MODE      = 'spsc'       # Valid: spsc (lock free, one producer / one consumer process) or mpmc
+SHM_INPUT_OVERFLOW  = 'drop_newest'  # Valid: block, drop_newest or overwrite_oldest (forces mpmc, so the spsc mode is lost)
+SHM_OUTPUT_OVERFLOW = 'block'
+DECODE_RING_SIZE    = 4 * 1024 * 1024  # Bytes of H264 packets buffered for the decode worker process
+ENCODE_RING_SIZE    = 4 * 1024 * 1024  # Bytes of H264 packets buffered from the encode worker process
+ENCODER_PRESET      = 'veryfast'       # libx264 preset, ultrafast ... veryslow
+ENCODER_TUNE        = 'zerolatency'
+ENCODER_THREADS     = 0                # libx264 threads, 0 = auto
+ENCODER_THREAD_TYPE = 'slice'          # Valid: slice (no added latency) or frame (scales better, adds ENCODER_THREADS frames of latency)
+ENCODER_SLICES      = 0                # Slices per frame, 0 = libx264 default
+ENCODER_RENDITIONS  = [                # Simulcast ladder (name, width, height, bit rate), heaviest first. Viewers pick one with ?rendition=
+    ('full', 640, 480, 2_000_000),
+    ('half', 320, 240,   600_000),
+    ('low',  320, 240,   250_000),
+]
+RENDITION_DOWNGRADE_AGE = 0.1  # Automatic viewers receiving frames this old (seconds) move to the next lighter rendition
+RENDITION_UPGRADE_AFTER = 5.0  # Seconds without lag before an automatic viewer moves back to a heavier rendition
+WS_BATCH_MAX_FRAMES = 8          # Packets a backed up ?framing=batch WebSocket viewer gets in one message
+WS_BATCH_MAX_BYTES  = 64 * 1024  # Stop adding packets to a message once it is this large
+REORDER_TIMEOUT       = 0.4    # Seconds the UDP dispatcher waits for a missing frame_id, until the link was measured
+REORDER_TIMEOUT_MIN   = 0.01   # Bounds of the adaptive gap wait
+REORDER_TIMEOUT_MAX   = 1.0
+REORDER_PERCENTILE    = 95     # Share (%) of the reordered / retransmitted frames the gap wait should still catch
+REORDER_JITTER_FACTOR = 3.0    # The gap wait is also at least this many times the inter-arrival jitter
+UDP_RECEIVE_BATCH = 64         # Datagrams the ingest listener reads per wakeup, 0 = one callback per datagram, which is also used automatically on loops without add_reader (Windows' proactor loop)
+STREAM_FPS = 30
 SHOW_FPS = bool(True)
 
 encoder = base_codec('libx264')
@@ -1,26 +1,29 @@
 import asyncio
+import multiprocessing.synchronize
 import struct
 import numpy as np
 import cv2
 import time
 import os
-from typing import List
 from inference import ShmQueue
 from .base import BaseConsumer
 from utils.logger import Log
+from utils.broadcast import BroadcastHub
+from utils.wire import WirePayload
 from constants import FFMPEG_DIR, SHOW_FPS, INFERENCE_ENABLED
 
 # Import ffmpeg
 if os.path.exists(FFMPEG_DIR):
     os.add_dll_directory(FFMPEG_DIR)
 import av
+from av.video.frame import PictureType
 from av.codec.hwaccel import HWAccel, HWDeviceType
-from utils.ffmpeg_helper import h264_nvenc, libx264_encoder
+from utils.ffmpeg_helper import EncoderConfig, get_encoder
 
 class JPG_TO_JPG_Consumer(BaseConsumer):
-    def __init__(self, output_queue: ShmQueue, frame_queue: List[asyncio.Queue]):
+    def __init__(self, output_queue: ShmQueue, frame_hub: BroadcastHub):
         super().__init__(output_queue)
-        self.frame_queue = frame_queue
+        self.frame_hub = frame_hub
         self.frame_count = 0
         self.prev_time = time.monotonic()
 
@@ -29,10 +32,8 @@ class JPG_TO_JPG_Consumer(BaseConsumer):
         _, buffer = cv2.imencode(".jpg", np_array, [int(cv2.IMWRITE_JPEG_QUALITY), 70])
         frame_bytes = buffer.tobytes()
 
-        timestamped_frame = (time.time(), frame_bytes)
-        for q in self.frame_queue:
-            if not q.full():
-                q.put_nowait(timestamped_frame)
+        timestamped_frame = (time.time(), WirePayload(frame_bytes))
+        self.frame_hub.publish(timestamped_frame)
 
         if SHOW_FPS:
             self.frame_count += 1
@@ -46,9 +47,9 @@ class JPG_TO_JPG_Consumer(BaseConsumer):
 
 
 class JPG_TO_H264_Consumer(BaseConsumer):
-    def __init__(self, output_queue: ShmQueue, frame_queue: List[asyncio.Queue], encode_queue: asyncio.Queue):
+    def __init__(self, output_queue: ShmQueue, frame_hub: BroadcastHub, encode_queue: asyncio.Queue):
         super().__init__(output_queue) 
-        self.frame_queue = frame_queue
+        self.frame_hub = frame_hub
         self.encode_queue = encode_queue
         self.frame_count = 0
         self.prev_time = time.monotonic()
@@ -57,37 +58,13 @@ class JPG_TO_H264_Consumer(BaseConsumer):
         if not self.encode_queue.full():
             self.encode_queue.put_nowait(_out)
     
-    async def encode(self, codec_name: str, device_type: str | HWDeviceType = None):
-        isHwSupported = False
-        isEncoderExist = False
-        try:
-            codec = av.Codec(codec_name, 'w')  
-            isEncoderExist = True
-
-            configs = codec.hardware_configs
-            if device_type is not None:
-                if not configs:
-                    raise ValueError(f"{codec_name} doesn't support {device_type}")
-                
-                if isinstance(device_type, HWDeviceType):
-                    device_type = device_type.name
-
-                for config in configs:
-                    if config.device_type.name == device_type and config.is_supported:
-                        isHwSupported = True
-                        break
-            
-        except Exception as e:
-            Log.exception(e, exc_info=False)
-
-        if isHwSupported or (isEncoderExist and codec_name == 'h264_nvenc'):
-            encoder = h264_nvenc()
-        else:
-            encoder = libx264_encoder()
+    async def encode(self, codec_name: str, device_type: str | HWDeviceType = None, config: EncoderConfig | None = None,
+                     keyframe_request: multiprocessing.synchronize.Event | None = None):
+        encoder = get_encoder(codec_name, device_type, config)
 
         while True:
             try:
-                frame, _= await self.encode_queue.get()
+                frame, frame_id = await self.encode_queue.get()
 
                 # If not matlike, then inference is disabled
                 if not isinstance(frame, cv2.typing.MatLike):
@@ -100,6 +77,9 @@ class JPG_TO_H264_Consumer(BaseConsumer):
 
                 img_yuv = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2YUV_I420)
                 video_frame = av.VideoFrame.from_ndarray(img_yuv, format='yuv420p')
+                if keyframe_request is not None and keyframe_request.is_set():
+                    keyframe_request.clear()
+                    video_frame.pict_type = PictureType.I
                 encoded_packet = await self.loop.run_in_executor(None, lambda: encoder.encode(video_frame))
 
                 if len(encoded_packet) == 0:
@@ -111,10 +91,8 @@ class JPG_TO_H264_Consumer(BaseConsumer):
                 # timestamp (8 byte) || frame_type (1 byte) || raw H.264  (N byte)
                 packet_data = struct.pack(">QB", timestamp_us, frame_type) + bytes(encoded_packet[0])
                 
-                timestamped_frame = (time.time(), packet_data)
-                for q in self.frame_queue:
-                    if not q.full():
-                        q.put_nowait(timestamped_frame)
+                timestamped_frame = (time.time(), WirePayload(packet_data, frame_id))
+                self.frame_hub.publish(timestamped_frame, frame_type == 1)
                 
                 if SHOW_FPS:
                     self.frame_count += 1
@@ -1,5 +1,6 @@
 from .base import BaseConsumer
 from .JPG import JPG_TO_JPG_Consumer, JPG_TO_H264_Consumer
-from .H264 import H264_TO_JPG_Consumer, H264_TO_H264_Consumer
+from .H264 import H264_TO_JPG_Consumer
+from .detections import DetectionConsumer
 
-__all__ = ['BaseConsumer', 'JPG_TO_JPG_Consumer', 'JPG_TO_H264_Consumer', 'H264_TO_JPG_Consumer', 'H264_TO_H264_Consumer']
\ No newline at end of file
+__all__ = ['BaseConsumer', 'JPG_TO_JPG_Consumer', 'JPG_TO_H264_Consumer', 'H264_TO_JPG_Consumer', 'DetectionConsumer']
\ No newline at end of file
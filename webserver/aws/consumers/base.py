@@ -1,17 +1,29 @@
 import asyncio
+import queue
 import numpy as np
 from typing import List
 from inference import ShmQueue, QueueStoppedError
 from utils.logger import Log
+from utils.frame_reorder import FrameReorderBuffer
+from constants import INFERENCE_WORKERS, INFERENCE_REORDER_WINDOW, INFERENCE_REORDER_DELAY
 
 class BaseConsumer:
     def __init__(self, output_queue: ShmQueue):
         self.output_queue = output_queue
         self.loop = asyncio.get_event_loop()
 
+        # Several inference workers finish frames out of order
+        self.reorder = None
+        if INFERENCE_WORKERS > 1:
+            self.reorder = FrameReorderBuffer(INFERENCE_REORDER_WINDOW, INFERENCE_REORDER_DELAY)
+
     async def handler(self):
         while True:
             try:
+                if self.reorder is not None:
+                    await self.__reorder_handler()
+                    continue
+
                 # tuple [ndarray, int]
                 _out = await self.loop.run_in_executor(None, self.output_queue.get)
 
@@ -28,6 +40,17 @@ class BaseConsumer:
                 break
             except Exception as e:
                 Log.exception(f"Error in handler: {e}")
+
+    async def __reorder_handler(self):
+        """Emit worker results in frame_id order, skipping gaps older than the reorder delay."""
+        try:
+            _out = await self.loop.run_in_executor(None, lambda: self.output_queue.get(timeout=self.reorder.max_delay / 2))
+            ready = self.reorder.push(_out[1], _out)
+        except queue.Empty:
+            ready = self.reorder.expire()
+
+        for _out in ready:
+            await self.process_handler(_out)
     
     async def process_handler(self, _out: tuple[np.ndarray, int]):
         """Process frame logic to be overridden by subclasses"""
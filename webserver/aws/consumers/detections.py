@@ -0,0 +1,70 @@
+import asyncio
+import json
+import multiprocessing.queues
+import queue
+import time
+from collections import OrderedDict
+from utils.logger import Log
+from utils.broadcast import BroadcastHub
+
+class DetectionConsumer:
+    """
+    Relay the detection records of the inference workers (metadata mode) to every viewer as a JSON text message.
+
+    Viewers receive the untouched H.264 packets next to it and match both through `timestamp_us`,
+    the timestamp of the 9-byte packet header, which the decoder registers with `remember`.
+
+    :param detection_queue: Side channel the inference workers write (frame_id, (height, width), detections) into
+    :param frame_hub: Viewer hub, detections are published as (time, str) next to the (time, WirePayload) packets
+    :param history: Max number of frame_id -> timestamp_us entries kept for frames still being inferred
+    """
+    def __init__(self, detection_queue: multiprocessing.queues.Queue, frame_hub: BroadcastHub, history=256):
+        self.detection_queue = detection_queue
+        self.frame_hub = frame_hub
+        self.history = history
+        self.timestamps: OrderedDict[int, int] = OrderedDict()
+        self.loop = asyncio.get_event_loop()
+
+    def remember(self, frame_id: int, timestamp_us: int):
+        """Register the packet timestamp of a frame sent to inference."""
+        self.timestamps[frame_id] = timestamp_us
+        if len(self.timestamps) > self.history:
+            self.timestamps.popitem(last=False)
+
+    def __get(self):
+        # Short timeout so the executor thread notices cancellation
+        try:
+            return self.detection_queue.get(timeout=0.5)
+        except queue.Empty:
+            return None
+
+    async def handler(self):
+        while True:
+            try:
+                record = await self.loop.run_in_executor(None, self.__get)
+
+                if record is None:
+                    continue
+
+                await self.process_handler(record)
+
+            except asyncio.CancelledError:
+                break
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                Log.exception(f"Error in detection handler: {e}")
+
+    async def process_handler(self, record: tuple[int, tuple[int, int], dict]):
+        frame_id, (height, width), detections = record
+        message = json.dumps({
+            "type": "detections",
+            "frame_id": frame_id,
+            "timestamp_us": self.timestamps.pop(frame_id, None),
+            "width": width,
+            "height": height,
+            **detections,
+        }, separators=(',', ':'))
+
+        timestamped_message = (time.time(), message)
+        self.frame_hub.publish(timestamped_message, keyframe=False)
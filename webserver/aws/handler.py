@@ -2,29 +2,31 @@
 import asyncio
 import ctypes
 import multiprocessing
-from multiprocessing import Lock, Semaphore, Value, Array
+from multiprocessing import Lock, Semaphore, Value
 import os
-from constants import INFERENCE_ENABLED, ServerContext, frame_queues, encode_queue, decode_queue, jpg_queue, EC2Port, encoder, decoder, ordered_queue, protocol_closed, frame_dispatch_reset
-from protocol import JPG_TO_JPG_PROTOCOL, JPG_TO_H264_PROTOCOL, H264_TO_JPG_PROTOCOL, H264_TO_H264_PROTOCOL, JPG_TO_JPG_TCP, JPG_TO_H264_TCP, H264_TO_JPG_TCP, H264_TO_H264_TCP
-from consumers import JPG_TO_JPG_Consumer, JPG_TO_H264_Consumer, H264_TO_JPG_Consumer, H264_TO_H264_Consumer
-from inference import ShmQueue, ObjectDetection, SyncObject
+from constants import INFERENCE_ENABLED, INFERENCE_MAX_BATCH, INFERENCE_MAX_WAIT, INFERENCE_WORKERS, INFERENCE_INTRA_OP_THREADS, INFERENCE_INTER_OP_THREADS, INFERENCE_EXECUTION_MODE, INFERENCE_GRAPH_OPT_LEVEL, INFERENCE_MODEL_CACHE, INFERENCE_IO_BINDING, INFERENCE_STRIDE, INFERENCE_MOTION_THRESHOLD, INFERENCE_OUTPUT, INCOMING_FORMAT, OUTGOING_FORMAT, Format, SHM_LATENCY_BUDGET, SHM_QUEUE_MODE, SHM_INPUT_OVERFLOW, SHM_OUTPUT_OVERFLOW, DECODE_RING_SIZE, ENCODE_RING_SIZE, ENCODER_PRESET, ENCODER_TUNE, ENCODER_THREADS, ENCODER_THREAD_TYPE, ENCODER_SLICES, ENCODER_RENDITIONS, STREAM_FPS, SHOW_FPS, ServerContext, frame_hub, rendition_hubs, encode_queue, decode_queue, jpg_queue, EC2Port, encoder, decoder, ordered_queue, protocol_closed, frame_dispatch_reset, UDP_RECEIVE_BATCH
+from protocol import BaseUDP, create_batched_endpoint, JPG_TO_JPG_PROTOCOL, JPG_TO_H264_PROTOCOL, H264_TO_JPG_PROTOCOL, H264_TO_H264_PROTOCOL, JPG_TO_JPG_TCP, JPG_TO_H264_TCP, H264_TO_JPG_TCP, H264_TO_H264_TCP
+from consumers import JPG_TO_JPG_Consumer, JPG_TO_H264_Consumer, H264_TO_JPG_Consumer, DetectionConsumer
+from inference import ShmQueue, ShmByteRing, ObjectDetection, SyncObject, SessionConfig
+from workers import DecodeWorker, EncodeWorker, publish_packets
+from utils.ffmpeg_helper import EncoderConfig, Rendition
 from utils.ordered_packet import OrderedPacketDispatcher
+from utils.broadcast import BroadcastHub
+from utils.packet_queue import ParameterSetCache
 import socket
 
 current_file = os.path.abspath(__file__)
 current_dir = os.path.dirname(current_file) 
 model_path = os.path.join(current_dir, "model", "v11_s_a.onnx")
+optimized_model_path = os.path.join(current_dir, "model", "v11_s_a.optimized.onnx")
 
 if not os.path.exists(model_path):
     raise FileNotFoundError(f"Model file not found at: {model_path}")
 
 ctx = ServerContext()
-SHM_CAPACITY = 600
+SHM_CAPACITY = ShmQueue.capacity_for(SHM_LATENCY_BUDGET, STREAM_FPS)
 
 sync_input = SyncObject(
-    frame_ids = Array(ctypes.c_int, SHM_CAPACITY),
-    head      = Value (ctypes.c_int, 0),               
-    tail      = Value (ctypes.c_int, 0),               
     stopping  = Value(ctypes.c_bool, False),
     s_full    = Semaphore(0),                
     s_empty   = Semaphore(SHM_CAPACITY),
@@ -33,9 +35,6 @@ sync_input = SyncObject(
 )
 
 sync_out = SyncObject(
-    frame_ids = Array(ctypes.c_int, SHM_CAPACITY),
-    head      = Value (ctypes.c_int, 0),               
-    tail      = Value (ctypes.c_int, 0),               
     stopping  = Value(ctypes.c_bool, False),
     s_full    = Semaphore(0),                
     s_empty   = Semaphore(SHM_CAPACITY),
@@ -43,13 +42,126 @@ sync_out = SyncObject(
     g_lock    = Lock()                                                            
 )
 
-ctx.input_queue  = ShmQueue(shape=(480,640,3),sync=sync_input, capacity=SHM_CAPACITY)
-ctx.output_queue = ShmQueue(shape=(480,640,3),sync=sync_out, capacity=SHM_CAPACITY)
+# spsc needs one producer and one consumer process per queue. Each queue has one on its other side (this
+# process, the decode worker or the encode worker), so that holds as long as there is a single inference worker
+queue_mode = SHM_QUEUE_MODE if INFERENCE_WORKERS == 1 else 'mpmc'
+ctx.input_queue  = ShmQueue(shape=(480,640,3),sync=sync_input, capacity=SHM_CAPACITY, mode=queue_mode, overflow=SHM_INPUT_OVERFLOW)
+
+# Metadata mode only applies where viewers can take the incoming packets as they are. Frames never come back
+# from inference there, detections go through a small side channel instead of the output ShmQueue
+metadata_mode = INFERENCE_ENABLED and INFERENCE_OUTPUT == 'metadata' and INCOMING_FORMAT.value == Format.H264.value and OUTGOING_FORMAT.value == Format.H264.value
+if metadata_mode:
+    ctx.detection_queue = multiprocessing.Queue(maxsize=SHM_CAPACITY)
+else:
+    ctx.output_queue = ShmQueue(shape=(480,640,3),sync=sync_out, capacity=SHM_CAPACITY, mode=queue_mode, overflow=SHM_OUTPUT_OVERFLOW)
+
+# H264 input is decoded by a worker process, the event loop only copies the packets into this ring
+if INFERENCE_ENABLED and INCOMING_FORMAT.value == Format.H264.value:
+    ctx.packet_ring = ShmByteRing(capacity=DECODE_RING_SIZE)
+
+# H264 output of inference is encoded by a worker process, once per rendition, the event loop only fans the packets out
+renditions = [Rendition(*rendition) for rendition in ENCODER_RENDITIONS]
+if INFERENCE_ENABLED and OUTGOING_FORMAT.value == Format.H264.value and not metadata_mode:
+    for rendition in renditions:
+        ctx.encoded_rings[rendition.name] = ShmByteRing(capacity=ENCODE_RING_SIZE)
+        ctx.keyframe_requests[rendition.name] = multiprocessing.Event()
+        rendition_hubs[rendition.name] = frame_hub if not rendition_hubs else BroadcastHub()
+
+# Viewers join H264 streams on the cached keyframe, make sure it carries the SPS / PPS.
+# Where the server encodes, the hubs can also ask the encoder for a keyframe
+if OUTGOING_FORMAT.value == Format.H264.value:
+    for hub in {frame_hub, *rendition_hubs.values()}:
+        hub.parameter_sets = ParameterSetCache()
+    ctx.keyframe_request = multiprocessing.Event()
+
+encoder_config = EncoderConfig(
+    preset      = ENCODER_PRESET,
+    tune        = ENCODER_TUNE,
+    threads     = ENCODER_THREADS,
+    thread_type = ENCODER_THREAD_TYPE,
+    slices      = ENCODER_SLICES,
+)
 
 def inference(**kwargs):
     onnx = ObjectDetection(**kwargs)
     onnx.run()
 
+def start_inference():
+    kwargs = {
+        "model_path": model_path,
+        "input_queue": ctx.input_queue,
+        "output_queue": ctx.output_queue,
+        "max_batch": INFERENCE_MAX_BATCH,
+        "max_wait": INFERENCE_MAX_WAIT,
+        "session_config": SessionConfig(
+            intra_op_num_threads     = INFERENCE_INTRA_OP_THREADS,
+            inter_op_num_threads     = INFERENCE_INTER_OP_THREADS,
+            execution_mode           = INFERENCE_EXECUTION_MODE,
+            graph_optimization_level = INFERENCE_GRAPH_OPT_LEVEL,
+            optimized_model_path     = optimized_model_path if INFERENCE_MODEL_CACHE else None,
+            io_binding               = INFERENCE_IO_BINDING,
+        ),
+        "stride": INFERENCE_STRIDE,
+        "motion_threshold": INFERENCE_MOTION_THRESHOLD,
+        "detection_queue": ctx.detection_queue,
+    }
+    # Every worker pulls from the same input queue, consumers restore frame_id order
+    for _ in range(INFERENCE_WORKERS):
+        infer_process = multiprocessing.Process(target=inference, kwargs=kwargs)
+        infer_process.start()
+        ctx.infer_processes.append(infer_process)
+
+def decode(**kwargs):
+    worker = DecodeWorker(**kwargs)
+    worker.run()
+
+def start_decoder():
+    kwargs = {
+        "packet_ring": ctx.packet_ring,
+        "input_queue": ctx.input_queue,
+        "decoder_name": decoder.name,
+        "device_type": decoder.device_type,
+    }
+    ctx.decode_process = multiprocessing.Process(target=decode, kwargs=kwargs)
+    ctx.decode_process.start()
+
+def encode(**kwargs):
+    worker = EncodeWorker(**kwargs)
+    worker.run()
+
+def start_encoder():
+    kwargs = {
+        "output_queue": ctx.output_queue,
+        "packet_rings": ctx.encoded_rings,
+        "codec_name": encoder.name,
+        "device_type": encoder.device_type,
+        "config": encoder_config,
+        "renditions": renditions,
+        "keyframe_requests": ctx.keyframe_requests,
+    }
+    # A viewer of one rendition only forces keyframes into that rendition
+    for name, hub in rendition_hubs.items():
+        hub.keyframe_requester = ctx.keyframe_requests[name].set
+    ctx.encode_process = multiprocessing.Process(target=encode, kwargs=kwargs)
+    ctx.encode_process.start()
+
+def request_source_keyframe():
+    # ctx.protocol is replaced on every stream reset
+    if isinstance(ctx.protocol, BaseUDP):
+        ctx.protocol.request_keyframe()
+
+async def open_udp_endpoint(protocol_factory, port: int):
+    if UDP_RECEIVE_BATCH > 0:
+        return await create_batched_endpoint(protocol_factory, ('0.0.0.0', port), UDP_RECEIVE_BATCH)
+    loop = asyncio.get_event_loop()
+    return await loop.create_datagram_endpoint(protocol_factory, local_addr=('0.0.0.0', port))
+
+async def publish_renditions():
+    await asyncio.gather(*(
+        publish_packets(encoded_ring, rendition_hubs[name], show_fps=SHOW_FPS and index == 0)
+        for index, (name, encoded_ring) in enumerate(ctx.encoded_rings.items())
+    ))
+
 '''
     TCP
 '''
@@ -57,7 +169,7 @@ class tcp_handle_jpg_to_jpg():
     @staticmethod
     async def start():
         loop = asyncio.get_event_loop()
-        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_queues
+        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_hub
         
         ctx.server = await loop.create_server(
             lambda: JPG_TO_JPG_TCP(protocol_input), host='0.0.0.0', port=EC2Port.TCP_PORT_JPG_TO_JPG.value)
@@ -65,15 +177,9 @@ class tcp_handle_jpg_to_jpg():
         print(f"TCP listener (JPG to JPG) started on 0.0.0.0:{EC2Port.TCP_PORT_JPG_TO_JPG.value}")
         
         if INFERENCE_ENABLED:
-            kwargs = {
-                "model_path": model_path,
-                "input_queue": ctx.input_queue,
-                "output_queue": ctx.output_queue,
-            }
-            ctx.infer_process = multiprocessing.Process(target=inference, kwargs=kwargs)
-            ctx.infer_process.start()
-
-            consumer = JPG_TO_JPG_Consumer(ctx.output_queue, frame_queues)
+            start_inference()
+
+            consumer = JPG_TO_JPG_Consumer(ctx.output_queue, frame_hub)
             ctx.consumer_task = asyncio.create_task(consumer.handler())
 
 class tcp_handle_jpg_to_h264(): 
@@ -85,67 +191,63 @@ class tcp_handle_jpg_to_h264():
             lambda: JPG_TO_H264_TCP(protocol_input), host='0.0.0.0', port=EC2Port.TCP_PORT_JPG_TO_H264.value)
         print(f"TCP listener (JPG to h264) started on 0.0.0.0:{EC2Port.TCP_PORT_JPG_TO_H264.value}")
         
-        consumer = JPG_TO_H264_Consumer(ctx.output_queue,frame_queues,encode_queue)
         if INFERENCE_ENABLED:
-            kwargs = {
-                "model_path": model_path,
-                "input_queue": ctx.input_queue,
-                "output_queue": ctx.output_queue,
-            }
-            ctx.infer_process = multiprocessing.Process(target=inference, kwargs=kwargs)
-            ctx.infer_process.start()
-            ctx.consumer_task = asyncio.create_task(consumer.handler())
-
-        ctx.encode_task  = asyncio.create_task(consumer.encode(encoder.name, encoder.device_type))
+            start_inference()
+            start_encoder()
+            ctx.encode_task = asyncio.create_task(publish_renditions())
+        else:
+            consumer = JPG_TO_H264_Consumer(ctx.output_queue,frame_hub,encode_queue)
+            frame_hub.keyframe_requester = ctx.keyframe_request.set
+            ctx.encode_task  = asyncio.create_task(consumer.encode(encoder.name, encoder.device_type, encoder_config, ctx.keyframe_request))
 
 class tcp_handle_h264_to_jpg():
     @staticmethod
     async def start():
         loop = asyncio.get_event_loop()
-        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_queues
 
         ctx.server = await loop.create_server(
             lambda: H264_TO_JPG_TCP(decode_queue), host='0.0.0.0', port=EC2Port.TCP_PORT_H264_TO_JPG.value)
         print(f"TCP listener (H264 to JPG) started on 0.0.0.0:{EC2Port.TCP_PORT_H264_TO_JPG.value}")
 
         if INFERENCE_ENABLED:
-            kwargs = {
-                "model_path": model_path,
-                "input_queue": ctx.input_queue,
-                "output_queue": ctx.output_queue,
-            }
-            ctx.infer_process = multiprocessing.Process(target=inference, kwargs=kwargs)
-            ctx.infer_process.start()
-
-            consumer = H264_TO_JPG_Consumer(ctx.output_queue, frame_queues)
+            start_inference()
+            start_decoder()
+
+            consumer = H264_TO_JPG_Consumer(ctx.output_queue, frame_hub)
             ctx.consumer_task = asyncio.create_task(consumer.handler())
         
-        ctx.decode_task = asyncio.create_task(H264_TO_JPG_TCP.decode(protocol_input, decode_queue, decoder.name, decoder.device_type))
+        decode_input = ctx.packet_ring if INFERENCE_ENABLED else frame_hub
+        ctx.decode_task = asyncio.create_task(H264_TO_JPG_TCP.decode(decode_input, decode_queue, decoder.name, decoder.device_type))
 
 class tcp_handle_h264_to_h264():
     @staticmethod
     async def start():
         loop = asyncio.get_event_loop()
-        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_queues
+        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_hub
+
+        passthrough = frame_hub if metadata_mode else None
 
         ctx.server = await loop.create_server(
-            lambda: H264_TO_H264_TCP(protocol_input, decode_queue),host='0.0.0.0', port=EC2Port.TCP_PORT_H264_TO_H264.value)
+            lambda: H264_TO_H264_TCP(protocol_input, decode_queue, passthrough),host='0.0.0.0', port=EC2Port.TCP_PORT_H264_TO_H264.value)
         
         print(f"TCP listener (H264 TO H264) started on 0.0.0.0:{EC2Port.TCP_PORT_H264_TO_H264.value}")
 
-        consumer = H264_TO_H264_Consumer(ctx.output_queue, frame_queues, encode_queue)
+        if metadata_mode:
+            start_inference()
+            start_decoder()
+
+            detections = DetectionConsumer(ctx.detection_queue, frame_hub)
+            ctx.detection_task = asyncio.create_task(detections.handler())
+            ctx.decode_task = asyncio.create_task(H264_TO_H264_TCP.decode(decode_queue, ctx.packet_ring, detections))
+            return
+
         if INFERENCE_ENABLED:
-            kwargs = {
-                "model_path": model_path,
-                "input_queue": ctx.input_queue,
-                "output_queue": ctx.output_queue,
-            }
-            ctx.infer_process = multiprocessing.Process(target=inference, kwargs=kwargs)
-            ctx.infer_process.start()
+            start_inference()
+            start_decoder()
+            start_encoder()
 
-            ctx.consumer_task = asyncio.create_task(consumer.handler())
-            ctx.decode_task = asyncio.create_task(H264_TO_H264_TCP.decode(decode_queue, protocol_input, decoder.name, decoder.device_type))
-            ctx.encode_task = asyncio.create_task(consumer.encode(encoder.name, encoder.device_type))
+            ctx.decode_task = asyncio.create_task(H264_TO_H264_TCP.decode(decode_queue, ctx.packet_ring))
+            ctx.encode_task = asyncio.create_task(publish_renditions())
 
 '''
     UDP
@@ -154,23 +256,16 @@ class tcp_handle_h264_to_h264():
 class handle_jpg_to_jpg(): 
     @staticmethod
     async def start():
-        loop = asyncio.get_event_loop()
-        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_queues
-        ctx.transport, protocol = await loop.create_datagram_endpoint(
-            lambda: JPG_TO_JPG_PROTOCOL(protocol_input, INFERENCE_ENABLED), local_addr=('0.0.0.0', EC2Port.UDP_PORT_JPG_TO_JPG.value)
+        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_hub
+        ctx.transport, protocol = await open_udp_endpoint(
+            lambda: JPG_TO_JPG_PROTOCOL(protocol_input, INFERENCE_ENABLED), EC2Port.UDP_PORT_JPG_TO_JPG.value
         )
         print(f"UDP listener (JPG to JPG) started on 0.0.0.0:{EC2Port.UDP_PORT_JPG_TO_JPG.value}")
         
         if INFERENCE_ENABLED:
-            kwargs = {
-                "model_path": model_path,
-                "input_queue": ctx.input_queue,
-                "output_queue": ctx.output_queue,
-            }
-            ctx.infer_process = multiprocessing.Process(target=inference, kwargs=kwargs)
-            ctx.infer_process.start()
-
-            consumer = JPG_TO_JPG_Consumer(ctx.output_queue, frame_queues)
+            start_inference()
+
+            consumer = JPG_TO_JPG_Consumer(ctx.output_queue, frame_hub)
             ctx.consumer_task = asyncio.create_task(consumer.handler())
             
         ctx.protocol = protocol
@@ -178,7 +273,6 @@ class handle_jpg_to_jpg():
     
     @staticmethod
     async def reset():
-        loop = asyncio.get_event_loop()
         if ctx.protocol:
             ctx.protocol.stop()
             await asyncio.sleep(0.2)
@@ -192,45 +286,41 @@ class handle_jpg_to_jpg():
             ctx.transport = None
 
         await asyncio.sleep(0.5)
-        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_queues
-        ctx.transport, ctx.protocol = await loop.create_datagram_endpoint(
-            lambda: JPG_TO_JPG_PROTOCOL(protocol_input, INFERENCE_ENABLED), local_addr=('0.0.0.0', EC2Port.UDP_PORT_JPG_TO_JPG.value)
+        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_hub
+        ctx.transport, ctx.protocol = await open_udp_endpoint(
+            lambda: JPG_TO_JPG_PROTOCOL(protocol_input, INFERENCE_ENABLED), EC2Port.UDP_PORT_JPG_TO_JPG.value
         )
         print(f"UDP listener (JPG to JPG) started on 0.0.0.0:{EC2Port.UDP_PORT_JPG_TO_JPG.value}")
 
 class handle_jpg_to_h264(): 
     @staticmethod
     async def start():
-        loop = asyncio.get_event_loop()
         protocol_input = ctx.input_queue if INFERENCE_ENABLED else encode_queue
-        ctx.transport, protocol = await loop.create_datagram_endpoint(
-            lambda: JPG_TO_H264_PROTOCOL(protocol_input, ordered_queue, INFERENCE_ENABLED), local_addr=('0.0.0.0', EC2Port.UDP_PORT_JPG_TO_H264.value)
+        ctx.transport, protocol = await open_udp_endpoint(
+            lambda: JPG_TO_H264_PROTOCOL(protocol_input, ordered_queue, INFERENCE_ENABLED), EC2Port.UDP_PORT_JPG_TO_H264.value
         )
         print(f"UDP listener (JPG to h264) started on 0.0.0.0:{EC2Port.UDP_PORT_JPG_TO_H264.value}")
         
 
-        consumer = JPG_TO_H264_Consumer(ctx.output_queue,frame_queues,encode_queue)
         if INFERENCE_ENABLED:
-            kwargs = {
-                "model_path": model_path,
-                "input_queue": ctx.input_queue,
-                "output_queue": ctx.output_queue,
-            }
-            ctx.infer_process = multiprocessing.Process(target=inference, kwargs=kwargs)
-            ctx.infer_process.start()
-            ctx.consumer_task = asyncio.create_task(consumer.handler())
+            start_inference()
+            start_encoder()
+            ctx.encode_task = asyncio.create_task(publish_renditions())
             ctx.jpg_producer_task = asyncio.create_task(JPG_TO_H264_PROTOCOL._producer(jpg_queue, protocol_input))
             ctx.protocol = protocol
-            ctx.ordering_task = asyncio.create_task(OrderedPacketDispatcher(ordered_queue, jpg_queue).run())
+            ctx.dispatcher = OrderedPacketDispatcher(ordered_queue, jpg_queue)
+            ctx.ordering_task = asyncio.create_task(ctx.dispatcher.run())
         else:
             ctx.protocol = protocol
-            ctx.ordering_task = asyncio.create_task(OrderedPacketDispatcher(ordered_queue, encode_queue).run())
+            ctx.dispatcher = OrderedPacketDispatcher(ordered_queue, encode_queue)
+            ctx.ordering_task = asyncio.create_task(ctx.dispatcher.run())
 
-        ctx.encode_task  = asyncio.create_task(consumer.encode(encoder.name, encoder.device_type))
+            consumer = JPG_TO_H264_Consumer(ctx.output_queue,frame_hub,encode_queue)
+            frame_hub.keyframe_requester = ctx.keyframe_request.set
+            ctx.encode_task  = asyncio.create_task(consumer.encode(encoder.name, encoder.device_type, encoder_config, ctx.keyframe_request))
 
     @staticmethod
     async def reset():
-        loop = asyncio.get_event_loop()
         if ctx.protocol:
             ctx.protocol.stop()
             await asyncio.sleep(0.2)
@@ -249,8 +339,8 @@ class handle_jpg_to_h264():
 
         await asyncio.sleep(0.5)
         protocol_input = ctx.input_queue if INFERENCE_ENABLED else encode_queue
-        ctx.transport, ctx.protocol = await loop.create_datagram_endpoint(
-            lambda: JPG_TO_H264_PROTOCOL(protocol_input, ordered_queue, INFERENCE_ENABLED), local_addr=('0.0.0.0', EC2Port.UDP_PORT_JPG_TO_H264.value)
+        ctx.transport, ctx.protocol = await open_udp_endpoint(
+            lambda: JPG_TO_H264_PROTOCOL(protocol_input, ordered_queue, INFERENCE_ENABLED), EC2Port.UDP_PORT_JPG_TO_H264.value
         )
         print(f"UDP listener (JPG to h264) started on 0.0.0.0:{EC2Port.UDP_PORT_JPG_TO_H264.value}")
 
@@ -259,33 +349,28 @@ class handle_jpg_to_h264():
 class handle_h264_to_jpg():
     @staticmethod
     async def start():
-        loop = asyncio.get_event_loop()
-        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_queues
+        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_hub
 
-        ctx.transport, protocol = await loop.create_datagram_endpoint(
-            lambda: H264_TO_JPG_PROTOCOL(protocol_input, decode_queue, ordered_queue, INFERENCE_ENABLED), local_addr=('0.0.0.0', EC2Port.UDP_PORT_H264_TO_JPG.value)
+        ctx.transport, protocol = await open_udp_endpoint(
+            lambda: H264_TO_JPG_PROTOCOL(protocol_input, decode_queue, ordered_queue, INFERENCE_ENABLED), EC2Port.UDP_PORT_H264_TO_JPG.value
         )
         print(f"UDP listener (Video JPG) started on 0.0.0.0:{EC2Port.UDP_PORT_H264_TO_JPG.value}")
 
         if INFERENCE_ENABLED:
-            kwargs = {
-                "model_path": model_path,
-                "input_queue": ctx.input_queue,
-                "output_queue": ctx.output_queue,
-            }
-            ctx.infer_process = multiprocessing.Process(target=inference, kwargs=kwargs)
-            ctx.infer_process.start()
-
-            consumer = H264_TO_JPG_Consumer(ctx.output_queue, frame_queues)
+            start_inference()
+            start_decoder()
+
+            consumer = H264_TO_JPG_Consumer(ctx.output_queue, frame_hub)
             ctx.consumer_task = asyncio.create_task(consumer.handler())
         
         ctx.protocol = protocol
-        ctx.decode_task = asyncio.create_task(protocol.decode(protocol_input, decode_queue, decoder.name, decoder.device_type))
-        ctx.ordering_task = asyncio.create_task(OrderedPacketDispatcher(ordered_queue, decode_queue).run())
+        decode_input = ctx.packet_ring if INFERENCE_ENABLED else frame_hub
+        ctx.decode_task = asyncio.create_task(protocol.decode(decode_input, decode_queue, decoder.name, decoder.device_type))
+        ctx.dispatcher = OrderedPacketDispatcher(ordered_queue, decode_queue, keyframe_requester=request_source_keyframe)
+        ctx.ordering_task = asyncio.create_task(ctx.dispatcher.run())
     
     @staticmethod
     async def reset():
-        loop = asyncio.get_event_loop()
         if ctx.protocol:
             ctx.protocol.stop()
             await asyncio.sleep(0.2)
@@ -303,9 +388,9 @@ class handle_h264_to_jpg():
                 await asyncio.sleep(0.5)
 
         await asyncio.sleep(0.5)
-        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_queues
-        ctx.transport, ctx.protocol = await loop.create_datagram_endpoint(
-            lambda: H264_TO_JPG_PROTOCOL(protocol_input, decode_queue, ordered_queue, INFERENCE_ENABLED), local_addr=('0.0.0.0', EC2Port.UDP_PORT_H264_TO_JPG.value)
+        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_hub
+        ctx.transport, ctx.protocol = await open_udp_endpoint(
+            lambda: H264_TO_JPG_PROTOCOL(protocol_input, decode_queue, ordered_queue, INFERENCE_ENABLED), EC2Port.UDP_PORT_H264_TO_JPG.value
         )
         print(f"UDP listener (Video JPG) started on 0.0.0.0:{EC2Port.UDP_PORT_H264_TO_JPG.value}")
 
@@ -315,38 +400,47 @@ class handle_h264_to_jpg():
 class handle_h264_to_h264():
     @staticmethod
     async def start():
-        loop = asyncio.get_event_loop()
-        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_queues
+        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_hub
 
-        ctx.transport, protocol = await loop.create_datagram_endpoint(
-            lambda: H264_TO_H264_PROTOCOL(protocol_input, decode_queue, ordered_queue, INFERENCE_ENABLED), local_addr=('0.0.0.0', EC2Port.UDP_PORT_H264_TO_H264.value)
+        ctx.transport, protocol = await open_udp_endpoint(
+            lambda: H264_TO_H264_PROTOCOL(protocol_input, decode_queue, ordered_queue, INFERENCE_ENABLED), EC2Port.UDP_PORT_H264_TO_H264.value
         )
         print(f"UDP listener (Video H264) started on 0.0.0.0:{EC2Port.UDP_PORT_H264_TO_H264.value}")
 
-        consumer = H264_TO_H264_Consumer(ctx.output_queue, frame_queues, encode_queue)
+        if metadata_mode:
+            start_inference()
+            start_decoder()
+
+            detections = DetectionConsumer(ctx.detection_queue, frame_hub)
+            ctx.detection_task = asyncio.create_task(detections.handler())
+            ctx.decode_task = asyncio.create_task(protocol.decode(decode_queue, ctx.packet_ring, detections))
+            ctx.protocol = protocol
+            frame_hub.keyframe_requester = request_source_keyframe
+            ctx.dispatcher = OrderedPacketDispatcher(ordered_queue, decode_queue, passthrough=frame_hub, keyframe_requester=request_source_keyframe)
+            ctx.ordering_task = asyncio.create_task(ctx.dispatcher.run())
+            return
+
         if INFERENCE_ENABLED:
-            kwargs = {
-                "model_path": model_path,
-                "input_queue": ctx.input_queue,
-                "output_queue": ctx.output_queue,
-            }
-            ctx.infer_process = multiprocessing.Process(target=inference, kwargs=kwargs)
-            ctx.infer_process.start()
+            start_inference()
+            start_decoder()
+            start_encoder()
 
-            ctx.consumer_task = asyncio.create_task(consumer.handler())
-            ctx.decode_task = asyncio.create_task(protocol.decode(decode_queue, protocol_input, decoder.name, decoder.device_type))
-            ctx.encode_task = asyncio.create_task(consumer.encode(encoder.name, encoder.device_type))
+            ctx.decode_task = asyncio.create_task(protocol.decode(decode_queue, ctx.packet_ring))
+            ctx.encode_task = asyncio.create_task(publish_renditions())
             ctx.protocol = protocol
-            ctx.ordering_task = asyncio.create_task(OrderedPacketDispatcher(ordered_queue, decode_queue).run())
+            ctx.dispatcher = OrderedPacketDispatcher(ordered_queue, decode_queue, keyframe_requester=request_source_keyframe)
+            ctx.ordering_task = asyncio.create_task(ctx.dispatcher.run())
         else:
             ctx.protocol = protocol
-            ctx.ordering_task = asyncio.create_task(OrderedPacketDispatcher(ordered_queue, frame_queues).run())
+            # Viewers get the packets of the Pi untouched, their keyframes come from it too
+            frame_hub.keyframe_requester = request_source_keyframe
+            ctx.dispatcher = OrderedPacketDispatcher(ordered_queue, frame_hub, keyframe_requester=request_source_keyframe)
+            ctx.ordering_task = asyncio.create_task(ctx.dispatcher.run())
 
         # original encode task here
 
     @staticmethod
     async def reset():
-        loop = asyncio.get_event_loop()
         if ctx.protocol:
             ctx.protocol.stop()
             await asyncio.sleep(0.2)
@@ -365,9 +459,9 @@ class handle_h264_to_h264():
             print("cleared 3333")
 
         await asyncio.sleep(0.5)
-        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_queues
-        ctx.transport, ctx.protocol = await loop.create_datagram_endpoint(
-            lambda: H264_TO_H264_PROTOCOL(protocol_input, decode_queue, ordered_queue, INFERENCE_ENABLED), local_addr=('0.0.0.0', EC2Port.UDP_PORT_H264_TO_H264.value)
+        protocol_input = ctx.input_queue if INFERENCE_ENABLED else frame_hub
+        ctx.transport, ctx.protocol = await open_udp_endpoint(
+            lambda: H264_TO_H264_PROTOCOL(protocol_input, decode_queue, ordered_queue, INFERENCE_ENABLED), EC2Port.UDP_PORT_H264_TO_H264.value
         )
         print(f"UDP listener (Video H264) started on 0.0.0.0:{EC2Port.UDP_PORT_H264_TO_H264.value}")
 
@@ -1,4 +1,6 @@
 from .shm_queue import ShmQueue, QueueStoppedError, SyncObject
-from .inference import ObjectDetection, get_onnx_status
+from .shm_ring import ShmByteRing
+from .scheduler import InferenceScheduler
+from .inference import ObjectDetection, SessionConfig, get_onnx_status, DETECTION_DTYPE, detections_to_dict
 
-__all__ = ['ShmQueue', 'QueueStoppedError', 'ObjectDetection', 'get_onnx_status', 'SyncObject']
+__all__ = ['ShmQueue', 'ShmByteRing', 'QueueStoppedError', 'ObjectDetection', 'SessionConfig', 'InferenceScheduler', 'get_onnx_status', 'SyncObject', 'DETECTION_DTYPE', 'detections_to_dict']
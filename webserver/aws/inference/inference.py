@@ -1,7 +1,13 @@
 import cv2
 import numpy as np
 import os
-from .shm_queue import ShmQueue
+from contextlib import ExitStack
+from dataclasses import dataclass
+import queue
+import time
+import multiprocessing.queues
+from .shm_queue import ShmQueue, QueueStoppedError
+from .scheduler import InferenceScheduler
 from utils.logger import Log
 import platform
 
@@ -15,18 +21,88 @@ except ImportError:
 def get_onnx_status():
     return isOnnxInstalled
 
+DETECTION_DTYPE = np.dtype([
+    ('box',      np.float32, (4,)),   # x1, y1, x2, y2 in original frame coordinates
+    ('score',    np.float32),
+    ('class_id', np.int32),
+])
+"""Row layout of the structured array returned by ObjectDetection.postprocess"""
+
+def detections_to_dict(detections: np.ndarray, class_names: list[str] | None = None) -> dict:
+    """
+    Convert a structured detection array into a JSON serializable dict of columns.
+    
+    :param detections: Structured array with DETECTION_DTYPE
+    :param class_names: Optional class names, adds a "labels" column when given
+    :return: {"boxes": [[x1, y1, x2, y2], ...], "scores": [...], "classes": [...]}
+    """
+    result = {
+        "boxes":   detections['box'].astype(np.int32).tolist(),
+        "scores":  np.round(detections['score'].astype(np.float64), 3).tolist(),
+        "classes": detections['class_id'].tolist(),
+    }
+    if class_names is not None:
+        result["labels"] = [class_names[class_id] for class_id in result["classes"]]
+    return result
+
+LETTERBOX_PAD = 114
+"""Gray value of the letterbox border, same as the ultralytics training pipeline"""
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable':  'ORT_DISABLE_ALL',
+    'basic':    'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all':      'ORT_ENABLE_ALL',
+}
+
+EXECUTION_MODES = {
+    'sequential': 'ORT_SEQUENTIAL',
+    'parallel':   'ORT_PARALLEL',
+}
+
+@dataclass
+class SessionConfig:
+    """
+    onnxruntime session tuning.
+
+    :param intra_op_num_threads: Threads used inside one operator, 0 lets onnxruntime pick (one per physical core).
+                                 Lower it when several workers share the machine
+    :param inter_op_num_threads: Threads used to run independent operators, only used by the parallel execution mode
+    :param execution_mode: sequential or parallel
+    :param graph_optimization_level: disable, basic, extended or all
+    :param optimized_model_path: Where the optimized graph is cached. When it is newer than the model it is loaded
+                                 as is, skipping graph optimization on startup. None disables the cache
+    :param io_binding: Run through IO binding with preallocated input / output buffers instead of session.run
+    """
+    intra_op_num_threads    : int = 0
+    inter_op_num_threads    : int = 0
+    execution_mode          : str = 'sequential'
+    graph_optimization_level: str = 'all'
+    optimized_model_path    : str | None = None
+    io_binding              : bool = True
+
 class ObjectDetection:
     """
     Initialize the ObjectDetection class.
     
     :param model_path: Path to the ONNX model
     :param input_queue: Input queue where frames will be processed
-    :param output_queue: Output queue where processed frame will be stored
+    :param output_queue: Output queue where processed frame will be stored. Unused when `detection_queue` is given
     :param input_size: The input size for the model (width, height)
     :param conf_threshold: Confidence threshold for filtering detections
     :param class_names: List of class names
+    :param max_batch: Max number of frames stacked into a single session.run call
+    :param max_wait: Max seconds to wait for more frames once the first frame of a batch arrived
+    :param session_config: onnxruntime session tuning, see SessionConfig
+    :param stride: Run the model every `stride` frames, skipped frames reuse the last detections
+    :param motion_threshold: Also run the model when the frame changed this much (mean gray level difference),
+                             0 disables motion gating. See InferenceScheduler
+    :param detection_queue: Side channel for metadata mode. When given, frames are not drawn on nor sent to
+                            `output_queue`, each frame emits a (frame_id, (height, width), detections dict) record instead
     """
-    def __init__(self, model_path: str, input_queue: ShmQueue, output_queue: ShmQueue, input_size=(640, 640), conf_threshold=0.25, class_names=None):
+    def __init__(self, model_path: str, input_queue: ShmQueue, output_queue: ShmQueue, input_size=(640, 640), conf_threshold=0.25, class_names=None,
+                 max_batch=1, max_wait=0.010, session_config: SessionConfig | None = None,
+                 stride=1, motion_threshold=0.0, detection_queue: multiprocessing.queues.Queue | None = None):
         if not isOnnxInstalled:
             raise RuntimeError("Onnxruntime Is Not Installed")
         
@@ -38,13 +114,12 @@ class ObjectDetection:
 
         self.input_queue  = input_queue
         self.output_queue = output_queue
+        self.detection_queue = detection_queue
         
         # Initialize the ONNX Runtime session
         self.model_path = model_path
-        self.sess_options = onnxruntime.SessionOptions()
-        self.sess_options.log_severity_level = 1
-        self.session = onnxruntime.InferenceSession(model_path, self.sess_options, 
-                                                    providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
+        self.session_config = session_config if session_config else SessionConfig()
+        self.session = self.create_session()
 
         # Get input and output names
         self.input_name = self.session.get_inputs()[0].name
@@ -55,77 +130,206 @@ class ObjectDetection:
         self.input_size = input_size
         self.conf_threshold = conf_threshold
 
-    def preprocess(self, image: cv2.typing.MatLike):
+        # A model exported with a fixed batch dimension can't take more than that
+        self.max_wait = max_wait
+        self.max_batch = max(1, max_batch)
+        batch_dim = self.session.get_inputs()[0].shape[0]
+        if isinstance(batch_dim, int) and batch_dim < self.max_batch:
+            Log.warning(f"Model has fixed batch size {batch_dim}, max_batch {self.max_batch} lowered to {batch_dim}")
+            self.max_batch = batch_dim
+
+        # Frame skipping, detections of the last inferred frame are drawn on skipped ones.
+        # With several workers each one schedules its own share of the frames
+        self.scheduler = InferenceScheduler(stride, motion_threshold)
+        self.last_detections = np.empty(0, dtype=DETECTION_DTYPE)
+
+        # Frames are preprocessed straight into this tensor, it is reused by every run
+        width, height = self.input_size
+        self.input_buffer = np.empty((self.max_batch, 3, height, width), dtype=np.float32)
+        self.letterbox_shape = None
+        self.resize_buffer = None
+
+        # IO binding buffers, bound once and reused by every run
+        self.io_binding = None
+        if self.session_config.io_binding:
+            self.init_io_binding()
+
+    def create_session(self):
         """
-        Preprocess the image: convert BGR to RGB, resize, normalize, and reformat dimensions.
+        Create the onnxruntime session from session_config.
+        A cached optimized model is loaded with graph optimization disabled since it is already applied,
+        otherwise the model is optimized and the result is written to the cache for the next start.
+        """
+        config = self.session_config
+        sess_options = onnxruntime.SessionOptions()
+        sess_options.log_severity_level = 1
+        sess_options.intra_op_num_threads = config.intra_op_num_threads
+        sess_options.inter_op_num_threads = config.inter_op_num_threads
+        sess_options.execution_mode = getattr(onnxruntime.ExecutionMode, EXECUTION_MODES[config.execution_mode])
+        optimization_level = getattr(onnxruntime.GraphOptimizationLevel, GRAPH_OPTIMIZATION_LEVELS[config.graph_optimization_level])
+        sess_options.graph_optimization_level = optimization_level
+        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+
+        cache_path = config.optimized_model_path
+        if cache_path is None:
+            return onnxruntime.InferenceSession(self.model_path, sess_options, providers=providers)
+
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(self.model_path):
+            try:
+                sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+                session = onnxruntime.InferenceSession(cache_path, sess_options, providers=providers)
+                Log.info(f"Loaded optimized model from {cache_path}")
+                return session
+            except Exception as e:
+                Log.warning(f"Optimized model cache {cache_path} unusable, rebuilding it: {e}")
+                sess_options.graph_optimization_level = optimization_level
+
+        # Several workers may start at once, each writes its own file and the last rename wins
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        sess_options.optimized_model_filepath = tmp_path
+        session = onnxruntime.InferenceSession(self.model_path, sess_options, providers=providers)
+        try:
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            Log.warning(f"Failed to write optimized model cache {cache_path}: {e}")
+        return session
+
+    def init_io_binding(self):
+        """
+        Preallocate the output buffer when the model output has a static shape besides the batch
+        dimension. Input and output are bound by pointer so onnxruntime reads and writes them
+        directly instead of allocating per run.
+        """
+        output_dims = self.session.get_outputs()[0].shape[1:]
+        self.output_buffer = None
+        if all(isinstance(dim, int) for dim in output_dims):
+            self.output_buffer = np.empty((self.max_batch, *output_dims), dtype=np.float32)
+        else:
+            Log.warning(f"Model output shape {output_dims} is dynamic, output buffer is allocated by onnxruntime")
+
+        self.io_binding = self.session.io_binding()
+        self.bound_batch = 0
+
+    def run_io_binding(self, batch_size: int) -> np.ndarray:
+        """
+        Run the session on the first `batch_size` rows of input_buffer.
+        
+        :return: Model output for the batch. It is a view onto output_buffer when there is one,
+                 valid until the next run
+        """
+        # Pointers never change, so bindings only need refreshing when the batch size does
+        if batch_size != self.bound_batch:
+            self.io_binding.bind_input(self.input_name, 'cpu', 0, np.float32,
+                                       [batch_size, *self.input_buffer.shape[1:]], self.input_buffer.ctypes.data)
+            if self.output_buffer is not None:
+                self.io_binding.bind_output(self.output_name, 'cpu', 0, np.float32,
+                                            [batch_size, *self.output_buffer.shape[1:]], self.output_buffer.ctypes.data)
+            else:
+                self.io_binding.bind_output(self.output_name, 'cpu')
+            self.bound_batch = batch_size
+
+        self.session.run_with_iobinding(self.io_binding)
+        if self.output_buffer is not None:
+            return self.output_buffer[:batch_size]
+        return self.io_binding.copy_outputs_to_cpu()[0]
+
+    def letterbox(self, frame_shape: tuple):
+        """
+        Scale and padding that fit a frame into the model input while keeping its aspect ratio.
+        
+        :param frame_shape: Shape of the original frame (height, width, channels)
+        :return: (ratio, resized width, resized height, left padding, top padding)
+        """
+        width, height = self.input_size
+        h_orig, w_orig = frame_shape[:2]
+        ratio = min(width / w_orig, height / h_orig)
+        new_w, new_h = round(w_orig * ratio), round(h_orig * ratio)
+        return ratio, new_w, new_h, (width - new_w) // 2, (height - new_h) // 2
+
+    def preprocess(self, image: cv2.typing.MatLike, index=0):
+        """
+        Letterbox the image into row `index` of input_buffer: resize keeping the aspect ratio,
+        then BGR to RGB, HWC to CHW and 0-255 to 0-1 in a single pass.
+        The gray border only changes with the frame shape, so it is filled once and left untouched.
         
         :param image: Input image to preprocess
-        :return: Preprocessed image as a tensor
-        """
-        # Convert to RGB
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        # Resize to model input size
-        resized = cv2.resize(image_rgb, self.input_size)
-        # Normalize (0-255 -> 0-1)
-        normalized = resized.astype(np.float32) / 255.0
-        # Change shape from (H, W, C) to (C, H, W)
-        transposed = np.transpose(normalized, (2, 0, 1))
-        # Add batch dimension: (1, C, H, W)
-        input_tensor = np.expand_dims(transposed, axis=0)
-        return input_tensor
-
-    def postprocess(self, outputs):
+        :param index: Row of input_buffer to write into
+        :return: Preprocessed image as a (1, C, H, W) view onto input_buffer
+        """
+        _, new_w, new_h, left, top = self.letterbox(image.shape)
+        if image.shape != self.letterbox_shape:
+            self.input_buffer.fill(LETTERBOX_PAD / 255.0)
+            self.resize_buffer = np.empty((new_h, new_w, 3), dtype=np.uint8)
+            self.letterbox_shape = image.shape
+
+        if image.shape[:2] != (new_h, new_w):
+            image = cv2.resize(image, (new_w, new_h), dst=self.resize_buffer, interpolation=cv2.INTER_LINEAR)
+
+        target = self.input_buffer[index, :, top:top + new_h, left:left + new_w]
+        np.multiply(image[..., ::-1].transpose(2, 0, 1), np.float32(1 / 255.0), out=target)
+        return self.input_buffer[index:index + 1]
+
+    def postprocess(self, detections: np.ndarray, frame_shape: tuple):
         """
         Postprocess the ONNX model output to filter detections based on confidence threshold.
+        Boxes are mapped from the letterboxed input back to the original frame in one vectorized pass.
         
-        :param outputs: Raw output from the model
-        :return: List of filtered detections
+        :param detections: Raw output from the model for a single image, shape (300, 6)
+        :param frame_shape: Shape of the original frame (height, width, channels)
+        :return: Structured array of filtered detections (see DETECTION_DTYPE)
         """
-        # Remove the batch dimension: shape becomes (300, 6)
-        detections = np.squeeze(outputs[0], axis=0)
-        boxes = []
-
-        for det in detections:
-            # det is expected to be an array with 6 elements: [x1, y1, x2, y2, score, class_id]
-            x1, y1, x2, y2, score, class_id = det
+        # det rows are [x1, y1, x2, y2, score, class_id]
+        kept = detections[detections[:, 4] >= self.conf_threshold]
 
-            if score >= self.conf_threshold:
-                boxes.append([x1, y1, x2, y2, score, int(class_id)])
+        h_orig, w_orig = frame_shape[:2]
+        ratio, _, _, left, top = self.letterbox(frame_shape)
+        offset = np.array([left, top] * 2, dtype=np.float32)
+        limit  = np.array([w_orig, h_orig] * 2, dtype=np.float32)
 
-        return boxes
+        result = np.empty(len(kept), dtype=DETECTION_DTYPE)
+        np.clip((kept[:, :4] - offset) / ratio, 0, limit, out=result['box'])
+        result['score']    = kept[:, 4]
+        result['class_id'] = kept[:, 5]
+        return result
 
     def infer(self, frame: cv2.typing.MatLike):
         """
         Perform inference on a single frame.
         
         :param frame: The input frame (image) to process
-        :return: List of detections with bounding boxes and class labels
+        :return: Structured array of detections with bounding boxes and class labels
+        """
+        return self.infer_batch([frame])[0]
+
+    def infer_batch(self, frames: list[cv2.typing.MatLike]):
         """
-        input_tensor = self.preprocess(frame)
-        outputs = self.session.run([self.output_name], {self.input_name: input_tensor})
-        detections = self.postprocess(outputs)
-        return detections
+        Perform inference on several frames with a single session.run call.
+        
+        :param frames: The input frames (images) to process
+        :return: One structured array of detections per frame, in the same order as `frames`
+        """
+        for i, frame in enumerate(frames):
+            self.preprocess(frame, i)
 
-    def draw_detections(self, frame: cv2.typing.MatLike, detections: list):
+        if self.io_binding is not None:
+            outputs = self.run_io_binding(len(frames))
+        else:
+            outputs = self.session.run([self.output_name], {self.input_name: self.input_buffer[:len(frames)]})[0]
+        return [self.postprocess(output, frame.shape) for output, frame in zip(outputs, frames)]
+
+    def draw_detections(self, frame: cv2.typing.MatLike, detections: np.ndarray):
         """
         Draw bounding boxes and labels on the frame.
         
         :param frame: The input frame (image) to draw on
-        :param detections: List of detections to draw
+        :param detections: Structured array of detections, already in frame coordinates
         :return: Frame with drawn detections
         """
-        for det in detections:
-            x1, y1, x2, y2, score, class_id = det
-
-            # Scale the bounding box back to the original image size
-            h_orig, w_orig = frame.shape[:2]
-            x_scale = w_orig / self.input_size[0]
-            y_scale = h_orig / self.input_size[1]
-            x1 = int(x1 * x_scale)
-            y1 = int(y1 * y_scale)
-            x2 = int(x2 * x_scale)
-            y2 = int(y2 * y_scale)
+        boxes = detections['box'].astype(np.int32).tolist()
+        scores = detections['score'].tolist()
+        class_ids = detections['class_id'].tolist()
 
+        for (x1, y1, x2, y2), score, class_id in zip(boxes, scores, class_ids):
             # Draw the bounding box
             cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
             label = f"{self.class_names[class_id]}: {score:.2f}"
@@ -133,20 +337,69 @@ class ObjectDetection:
 
         return frame
 
+    def emit_detections(self, frame: cv2.typing.MatLike, frame_id: int, detections: np.ndarray):
+        """
+        Send the detections of a frame over the side channel, dropping the record when nobody keeps up with it.
+        
+        :param frame: The frame the detections belong to, only its shape is sent
+        :param frame_id: frame_id of the frame
+        :param detections: Structured array of detections, already in frame coordinates
+        """
+        record = (frame_id, frame.shape[:2], detections_to_dict(detections, self.class_names))
+        try:
+            self.detection_queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+    def collect_batch(self, stack: ExitStack) -> list[tuple[np.ndarray, int]]:
+        """
+        Block until one frame is available, then keep draining the input queue
+        until `max_batch` frames are collected or `max_wait` seconds have passed.
+        Frames are borrowed views onto the input queue, released when `stack` closes.
+        
+        :param stack: ExitStack that owns the borrowed input slots
+        :return: List of (frame, frame_id)
+        """
+        batch = [stack.enter_context(self.input_queue.borrow())]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(stack.enter_context(self.input_queue.borrow(timeout=remaining)))
+            except queue.Empty:
+                break
+
+        return batch
+
     def run(self):
         while True:
             try:
-                frame, frame_id = self.input_queue.get()
-                
-                # Perform inference
-                detections = self.infer(frame)
-                
-                # Draw detections on the frame
-                frame = self.draw_detections(frame, detections)
+                with ExitStack() as stack:
+                    batch = self.collect_batch(stack)
+                    scheduled = [self.scheduler.should_infer(frame) for frame, _ in batch]
+
+                    # Perform inference, only on the frames picked by the scheduler
+                    frames = [frame for (frame, _), run in zip(batch, scheduled) if run]
+                    batch_detections = iter(self.infer_batch(frames) if frames else [])
 
-                self.output_queue.put(frame.copy(), frame_id)
+                    # Fan detections back out, in the order the frames were received. A skipped frame
+                    # carries forward the detections of the last inferred frame before it.
+                    # Boxes are drawn in place on the borrowed input slot, then copied once into the output queue
+                    for (frame, frame_id), run in zip(batch, scheduled):
+                        if run:
+                            self.last_detections = next(batch_detections)
+                        if self.detection_queue is not None:
+                            self.emit_detections(frame, frame_id, self.last_detections)
+                            continue
+                        frame = self.draw_detections(frame, self.last_detections)
+                        self.output_queue.put(frame, frame_id)
 
             except KeyboardInterrupt:
                 break
+            except QueueStoppedError:
+                break
             except Exception as e:
                 Log.exception(f"error at inference: {e}")
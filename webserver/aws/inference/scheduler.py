@@ -0,0 +1,62 @@
+import cv2
+import numpy as np
+
+MOTION_THUMBNAIL = (80, 60)
+"""(width, height) frames are shrunk to before they are compared"""
+
+class InferenceScheduler:
+    """
+    Decide which frames go through the model. Skipped frames reuse the last detections.
+
+    The model runs at least every `stride` frames. With `motion_threshold` set it also runs as soon as
+    the frame differs enough from the last inferred one, so a large stride turns into a motion-gated
+    schedule with a periodic refresh.
+
+    Motion score is the mean absolute gray level difference (0-255) between small thumbnails of the
+    frame and of the last inferred frame, comparing against the last inferred frame instead of the
+    previous one so slow changes still add up.
+
+    :param stride: Run the model every `stride` frames, 1 runs it on every frame
+    :param motion_threshold: Motion score that triggers the model early, 0 disables motion gating
+    """
+    def __init__(self, stride=1, motion_threshold=0.0):
+        self.stride = max(1, stride)
+        self.motion_threshold = motion_threshold
+        self.reference: np.ndarray | None = None
+        self.since_last: int | None = None
+        self.inferred = 0
+        self.skipped = 0
+
+    def reset(self):
+        self.reference = None
+        self.since_last = None
+
+    def motion_score(self, thumbnail: np.ndarray) -> float:
+        if self.reference is None:
+            return float('inf')
+        return cv2.norm(thumbnail, self.reference, cv2.NORM_L1) / thumbnail.size
+
+    def should_infer(self, frame: cv2.typing.MatLike) -> bool:
+        """
+        :param frame: BGR frame about to be processed
+        :return: True when the model has to run on this frame
+        """
+        thumbnail = self.thumbnail(frame) if self.motion_threshold > 0 else None
+        run = self.since_last is None or self.since_last + 1 >= self.stride
+        if not run and thumbnail is not None:
+            run = self.motion_score(thumbnail) >= self.motion_threshold
+
+        if not run:
+            self.since_last += 1
+            self.skipped += 1
+            return False
+
+        self.reference = thumbnail
+        self.since_last = 0
+        self.inferred += 1
+        return True
+
+    @staticmethod
+    def thumbnail(frame: cv2.typing.MatLike) -> np.ndarray:
+        small = cv2.resize(frame, MOTION_THUMBNAIL, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
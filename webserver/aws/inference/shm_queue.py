@@ -1,18 +1,41 @@
-import ctypes
+import math
+import os
+import platform
+import queue
+import select
+import threading
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass
-from multiprocessing import Lock, Semaphore, Value, shared_memory, Array
-from multiprocessing.sharedctypes import Synchronized, SynchronizedArray
+from multiprocessing import shared_memory
+from multiprocessing.sharedctypes import Synchronized
 from multiprocessing.synchronize import Lock as _Lock
 from multiprocessing.synchronize import Semaphore as _Semaphore
-from multiprocessing.synchronize import Semaphore as _Semaphore
 
 import numpy as np
+from utils.logger import Log
+
+INVALID_FRAME_ID = -1
+
+# Arena header: int64 counters, then per-slot frame_id / timestamp / sequence arrays, then the slots
+HEAD, TAIL, CONSUMER_WAITING, PRODUCER_WAITING, STOPPED, DROPPED_NEWEST, DROPPED_OLDEST = 0, 1, 2, 3, 4, 5, 6
+HEADER_COUNTERS = 8
+ARENA_ALIGN = 64
+
+MODE_MPMC = 'mpmc'
+MODE_SPSC = 'spsc'
+
+# What put() / reserve() do when the queue is full
+OVERFLOW_BLOCK            = 'block'
+OVERFLOW_DROP_NEWEST      = 'drop_newest'
+OVERFLOW_OVERWRITE_OLDEST = 'overwrite_oldest'
+
+# Upper bound on a single eventfd wait, covers the rare lost wakeup between the waiting flag and the check
+SPSC_WAKEUP_TIMEOUT = 0.005
+SPSC_POLL_INTERVAL  = 0.0005
 
 @dataclass
 class SyncObject:
-    frame_ids : SynchronizedArray
-    head      : Synchronized
-    tail      : Synchronized
     stopping  : Synchronized
     s_full    : _Semaphore
     s_empty   : _Semaphore
@@ -23,82 +46,369 @@ class SyncObject:
 class QueueStoppedError(Exception):
     pass
 
+def _align(size: int) -> int:
+    return (size + ARENA_ALIGN - 1) // ARENA_ALIGN * ARENA_ALIGN
+
 class ShmQueue:
-    def __init__(self, shape, sync: SyncObject, dtype=np.uint8, capacity=120):
+    """
+    Fixed capacity frame queue shared between processes.
+
+    Every slot lives in one contiguous SharedMemory arena:
+
+        | counters (head, tail) | frame_ids | timestamps | slot_seq | slot 0 | slot 1 | ... |
+
+    head / tail are monotonically increasing positions (slot index = position % capacity).
+    slot_seq tracks the lap each slot is on, so a producer never overwrites a slot that is
+    still borrowed and a consumer never reads a slot that is still being written,
+    even when slots are released out of order.
+
+    :param shape: Shape of a single frame
+    :param sync: Semaphores / locks shared with the other processes
+    :param dtype: Frame dtype
+    :param capacity: Number of frame slots, see ShmQueue.capacity_for
+    :param mode: 'mpmc' (semaphores + locks, any number of producer / consumer processes) or
+                 'spsc' (one producer process, one consumer process, lock free, see below)
+    :param overflow: What a producer does when the queue is full:
+                     'block' waits for a free slot, 'drop_newest' discards the incoming frame,
+                     'overwrite_oldest' discards the oldest queued frame to make room.
+                     Dropped frames are counted in stats().
+
+    In 'spsc' mode the slot sequence numbers are the only synchronization: the producer waits
+    for a slot to be freed, the consumer waits for it to be published, and each side only
+    touches the other with an eventfd write when the other side flagged itself as waiting.
+    Threads inside the producer (or consumer) process are serialized with a plain threading.Lock.
+    This relies on the total store order of x86-64; on other CPUs the queue falls back to 'mpmc'.
+    Without eventfd (non Linux, or a queue pickled into a spawned process) waits degrade to polling.
+    'overwrite_oldest' has to advance the consumer side head from the producer, which needs
+    the cross-process locks, so it always runs in 'mpmc' mode.
+    """
+    def __init__(self, shape, sync: SyncObject, dtype=np.uint8, capacity=120, mode=MODE_MPMC, overflow=OVERFLOW_BLOCK):
         self.shape = shape
         self.dtype = np.dtype(dtype)
         self.capacity = capacity
         self.frame_size = int(np.prod(shape))
+        self.slot_size = _align(self.frame_size * self.dtype.itemsize)
 
-        # Shared memory blocks for each frame
-        self.shms = [
-            shared_memory.SharedMemory(create=True, size=self.frame_size * self.dtype.itemsize)
-            for _ in range(capacity)
-        ]
-        self.names = [shm.name for shm in self.shms]
+        self.header_size = _align(HEADER_COUNTERS * 8 + capacity * 8 * 3)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.header_size + capacity * self.slot_size)
+        self.name = self.shm.name
+        self._map()
 
-        self.frame_ids = sync.frame_ids 
+        self.counters[:] = 0
+        self.frame_ids[:] = INVALID_FRAME_ID
+        self.timestamps[:] = 0.0
+        self.slot_seq[:] = np.arange(capacity)
 
-        # Circular queue pointers (head, tail)
-        self.head = sync.head
-        self.tail = sync.tail
         self.stopping = sync.stopping
 
         # Queue slot availability semaphores
-        self.s_full  = sync.s_full 
+        self.s_full  = sync.s_full
         self.s_empty = sync.s_empty
         self.p_lock  = sync.p_lock
         self.g_lock  = sync.g_lock
 
+        if mode == MODE_SPSC and platform.machine().lower() not in ('x86_64', 'amd64'):
+            Log.warning(f"ShmQueue spsc mode needs x86-64 store ordering, using mpmc on {platform.machine()}")
+            mode = MODE_MPMC
+        if mode == MODE_SPSC and overflow == OVERFLOW_OVERWRITE_OLDEST:
+            Log.warning("ShmQueue overwrite_oldest needs the mpmc locks, using mpmc instead of spsc")
+            mode = MODE_MPMC
+        self.mode = mode
+
+        assert overflow in (OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_OVERWRITE_OLDEST), f"Unknown overflow policy {overflow}"
+        self.overflow = overflow
+
+        self.efd_items = None
+        self.efd_space = None
+        if self.mode == MODE_SPSC and hasattr(os, 'eventfd'):
+            self.efd_items = os.eventfd(0, os.EFD_NONBLOCK)
+            self.efd_space = os.eventfd(0, os.EFD_NONBLOCK)
+        self._local_locks()
+
+    @staticmethod
+    def capacity_for(latency_budget: float, fps: float) -> int:
+        """
+        Number of slots needed to buffer `latency_budget` seconds of video at `fps`.
+        Anything beyond that is stale by the time it is consumed.
+        """
+        return max(2, math.ceil(latency_budget * fps))
+
+    def _map(self):
+        """Create the numpy views onto the arena header and slots."""
+        buf = self.shm.buf
+        cap = self.capacity
+        offset = HEADER_COUNTERS * 8
+
+        self.counters   = np.ndarray((HEADER_COUNTERS,), dtype=np.int64, buffer=buf)
+        self.frame_ids  = np.ndarray((cap,), dtype=np.int64, buffer=buf, offset=offset)
+        self.timestamps = np.ndarray((cap,), dtype=np.float64, buffer=buf, offset=offset + cap * 8)
+        self.slot_seq   = np.ndarray((cap,), dtype=np.int64, buffer=buf, offset=offset + cap * 16)
+        self.slots = [
+            np.ndarray(self.shape, dtype=self.dtype, buffer=buf, offset=self.header_size + i * self.slot_size)
+            for i in range(cap)
+        ]
+
+    def _local_locks(self):
+        # Serialize threads of the same process in spsc mode
+        self._put_lock = threading.Lock()
+        self._get_lock = threading.Lock()
+
+    def _unmap(self):
+        self.counters = self.frame_ids = self.timestamps = self.slot_seq = None
+        self.slots = []
+
+    def __getstate__(self):
+        # Views are rebuilt from the SharedMemory name in the child (spawn start method)
+        state = self.__dict__.copy()
+        for key in ('counters', 'frame_ids', 'timestamps', 'slot_seq', 'slots', '_put_lock', '_get_lock'):
+            state.pop(key, None)
+        # eventfds are only inherited through fork
+        state['efd_items'] = state['efd_space'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map()
+        self._local_locks()
+
+    def _wait_seq(self, idx: int, expected: int):
+        """Wait for a slot to reach the expected lap. Only spins when slots are released out of order."""
+        delay = 0.0
+        while self.slot_seq[idx] != expected:
+            time.sleep(delay)
+            delay = min(0.001, delay + 0.0001)
+
+    def _spsc_wait(self, idx: int, expected: int, flag: int, efd: int | None, deadline: float | None) -> bool:
+        """
+        Wait until slot `idx` reaches `expected` in spsc mode.
+
+        :param flag: Header counter used to tell the other side we are sleeping
+        :param efd: eventfd the other side writes to when `flag` is set
+        :param deadline: time.monotonic() deadline, None waits forever
+        :return: False if the deadline passed
+        """
+        while self.slot_seq[idx] != expected:
+            if self.counters[STOPPED]:
+                raise QueueStoppedError()
+
+            timeout = SPSC_WAKEUP_TIMEOUT if efd is not None else SPSC_POLL_INTERVAL
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                timeout = min(timeout, remaining)
+
+            self.counters[flag] = 1
+            # Re-check after raising the flag, the other side may have published just before
+            if self.slot_seq[idx] != expected:
+                if efd is not None:
+                    if select.select([efd], [], [], timeout)[0]:
+                        try:
+                            os.eventfd_read(efd)
+                        except BlockingIOError:
+                            pass
+                else:
+                    time.sleep(timeout)
+            self.counters[flag] = 0
+        return True
+
+    def _spsc_notify(self, flag: int, efd: int | None):
+        if efd is not None and self.counters[flag]:
+            os.eventfd_write(efd, 1)
+
+    def _claim_write(self) -> int | None:
+        """Wait until the next slot is free and return its position, or None if the frame is dropped."""
+        if self.mode == MODE_SPSC:
+            with self._put_lock:
+                pos = int(self.counters[TAIL])
+                if self.overflow == OVERFLOW_DROP_NEWEST and self.slot_seq[pos % self.capacity] != pos:
+                    self.counters[DROPPED_NEWEST] += 1
+                    return None
+                self._spsc_wait(pos % self.capacity, pos, PRODUCER_WAITING, self.efd_space, None)
+                self.counters[TAIL] = pos + 1
+            return pos
+
+        if not self.s_empty.acquire(False):
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                with self.p_lock:
+                    self.counters[DROPPED_NEWEST] += 1
+                return None
+            if self.overflow == OVERFLOW_OVERWRITE_OLDEST:
+                self._drop_oldest()
+            # Block until there is space in the queue
+            self.s_empty.acquire()
+
+        with self.p_lock:
+            pos = int(self.counters[TAIL])
+            self.counters[TAIL] = pos + 1
+
+        self._wait_seq(pos % self.capacity, pos)
+        return pos
+
+    def _drop_oldest(self):
+        """Discard the oldest queued frame (mpmc only). Borrowed frames are never touched."""
+        if not self.s_full.acquire(False):
+            return  # Everything is borrowed, wait for a consumer to release instead
+
+        if self.stopping.value:
+            self.s_full.release()
+            return
+
+        with self.g_lock:
+            pos = int(self.counters[HEAD])
+            self.counters[HEAD] = pos + 1
+
+        self._wait_seq(pos % self.capacity, pos + 1)
+        self._release(pos)
+
+        with self.p_lock:
+            self.counters[DROPPED_OLDEST] += 1
+
+    def _publish(self, pos: int):
+        idx = pos % self.capacity
+        self.timestamps[idx] = time.time()
+        self.slot_seq[idx] = pos + 1
+
+        if self.mode == MODE_SPSC:
+            self._spsc_notify(CONSUMER_WAITING, self.efd_items)
+        else:
+            self.s_full.release()  # Signal that there is an item available for consumption
+
+    def _claim_read(self, timeout: float | None) -> int:
+        """Block until the oldest slot is published and return its position."""
+        if self.mode == MODE_SPSC:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            with self._get_lock:
+                pos = int(self.counters[HEAD])
+                if not self._spsc_wait(pos % self.capacity, pos + 1, CONSUMER_WAITING, self.efd_items, deadline):
+                    raise queue.Empty()
+                self.counters[HEAD] = pos + 1
+            return pos
+
+        # Block until there is an item in the queue
+        if not self.s_full.acquire(timeout=timeout):
+            raise queue.Empty()
+
+        if self.stopping.value:
+            self.s_full.release()
+            self.s_empty.release()
+            raise QueueStoppedError()
+
+        with self.g_lock:
+            pos = int(self.counters[HEAD])
+            self.counters[HEAD] = pos + 1
+
+        self._wait_seq(pos % self.capacity, pos + 1)
+        return pos
+
+    def _release(self, pos: int):
+        self.slot_seq[pos % self.capacity] = pos + self.capacity
+
+        if self.mode == MODE_SPSC:
+            self._spsc_notify(PRODUCER_WAITING, self.efd_space)
+        else:
+            self.s_empty.release()  # Signal that there is space available in the queue
+
     def stop(self):
         with self.stopping.get_lock():
             if self.stopping.value == True:
                 return
             self.stopping.value = True
+            self.counters[STOPPED] = 1
+
+            if self.mode == MODE_SPSC:
+                for efd in (self.efd_items, self.efd_space):
+                    if efd is not None:
+                        os.eventfd_write(efd, 1)
+                return
+
             # Wake up any blocked consumers
             for _ in range(self.capacity):
                 self.s_full.release()  # Ensure .get() unblocks
 
-    def put(self, frame: np.ndarray, frame_id: int):
-        # Block until there is space in the queue
-        self.s_empty.acquire()
-        
-        with self.p_lock:
-            idx = self.tail.value
-            self.tail.value = (idx + 1) % self.capacity
+    def put(self, frame: np.ndarray, frame_id: int) -> bool:
+        """
+        Copy a frame into the queue.
 
-        shm = self.shms[idx]
-        buf = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
-        np.copyto(buf, frame)
+        :return: False if the frame was dropped by the 'drop_newest' overflow policy
+        """
+        with self.reserve(frame_id) as slot:
+            if slot is None:
+                return False
+            np.copyto(slot, frame)
+        return True
 
-        self.frame_ids[idx] = frame_id
-        self.s_full.release()  # Signal that there is an item available for consumption
+    @contextmanager
+    def reserve(self, frame_id: int):
+        """
+        Claim the next free slot and yield a writable view onto it, so producers can
+        write (e.g. cv2.cvtColor(..., dst=slot)) straight into shared memory.
+        The slot is published to consumers when the block exits.
 
+        A slot can't be given back once claimed, so if the block raises the slot is
+        still published but flagged invalid and skipped by get() / borrow().
 
-    def get(self) -> tuple[np.ndarray, int]:
-        # Block until there is an item in the queue
-        self.s_full.acquire() 
+        With the 'drop_newest' overflow policy, None is yielded when the queue is full.
+
+        :param frame_id: Frame id stored alongside the slot
+        """
+        pos = self._claim_write()
+        if pos is None:
+            yield None
+            return
+        idx = pos % self.capacity
+
+        try:
+            yield self.slots[idx]
+            self.frame_ids[idx] = frame_id
+        except BaseException:
+            self.frame_ids[idx] = INVALID_FRAME_ID
+            raise
+        finally:
+            self._publish(pos)
+
+    def get(self, timeout: float | None = None) -> tuple[np.ndarray, int]:
+        """
+        Pop the oldest frame from the queue.
+
+        :param timeout: Seconds to wait for a frame. None blocks forever
+        :raises queue.Empty: No frame arrived within `timeout`
+        :raises QueueStoppedError: The queue has been stopped
+        """
+        with self.borrow(timeout) as (frame, frame_id):
+            return frame.copy(), frame_id
+
+    @contextmanager
+    def borrow(self, timeout: float | None = None):
+        """
+        Take the oldest frame and yield (view, frame_id) without copying it out of shared memory.
+        The slot is only handed back to producers when the block exits, so the view must not
+        be used afterwards.
+
+        :param timeout: Seconds to wait for a frame. None blocks forever
+        :raises queue.Empty: No frame arrived within `timeout`
+        :raises QueueStoppedError: The queue has been stopped
+        """
+        while True:
+            pos = self._claim_read(timeout)
+            idx = pos % self.capacity
+
+            frame_id = int(self.frame_ids[idx])
+            if frame_id != INVALID_FRAME_ID:
+                break
+
+            # Producer failed while writing this slot, drop it
+            self._release(pos)
+
+        try:
+            yield self.slots[idx], frame_id
+        finally:
+            self._release(pos)
 
-        if self.stopping.value:
-            self.s_full.release()
-            self.s_empty.release()
-            raise QueueStoppedError()
-        
-        with self.g_lock:
-            idx = self.head.value
-            self.head.value = (idx + 1) % self.capacity
-            
-        shm = self.shms[idx]
-        frame = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf).copy()
-        frame_id = int(self.frame_ids[idx])
-        self.s_empty.release()  # Signal that there is space available in the queue
-        return frame, frame_id
-    
     def qsize(self) -> int:
         """Return the current number of frames in the queue."""
-        # Must be synchronized to avoid race conditions
-        with self.p_lock, self.g_lock:
-            return (self.tail.value - self.head.value + self.capacity) % self.capacity
+        size = int(self.counters[TAIL]) - int(self.counters[HEAD])
+        return min(max(size, 0), self.capacity)
 
     def empty(self) -> bool:
         """Return True if the queue is empty."""
@@ -108,11 +418,31 @@ class ShmQueue:
         """Return True if the queue is full."""
         return self.qsize() == self.capacity
 
+    def latency(self) -> float:
+        """Return how long (seconds) the oldest queued frame has been waiting, 0 if empty."""
+        if self.empty():
+            return 0.0
+        return max(0.0, time.time() - float(self.timestamps[int(self.counters[HEAD]) % self.capacity]))
+
+    def stats(self) -> dict:
+        """Return queue depth, dropped frame counters and the age of the oldest queued frame."""
+        return {
+            "queued": self.qsize(),
+            "dropped_newest": int(self.counters[DROPPED_NEWEST]),
+            "dropped_oldest": int(self.counters[DROPPED_OLDEST]),
+            "latency": self.latency(),
+        }
+
     def cleanup(self):
-        for shm in self.shms:
-            shm.close()
-            try:
-                shm.unlink()
-            except FileNotFoundError:
-                pass
-        
\ No newline at end of file
+        for efd in (self.efd_items, self.efd_space):
+            if efd is not None:
+                os.close(efd)
+        self.efd_items = self.efd_space = None
+
+        # Views must be released before the mapping can be closed
+        self._unmap()
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,147 @@
+import multiprocessing
+import queue
+import struct
+from multiprocessing import shared_memory
+
+import numpy as np
+from .shm_queue import QueueStoppedError
+
+# Header: int64 counters, then the data region
+HEAD, TAIL, STOPPED, DROPPED = 0, 1, 2, 3
+HEADER_COUNTERS = 8
+
+RECORD = struct.Struct('<Iq')   # payload length, frame_id
+LENGTH = struct.Struct('<I')    # only the length fits in the last 8 bytes of the region
+RECORD_ALIGN = 8
+WRAP = 0xFFFFFFFF               # length marking the unused tail of the region, the next record starts at offset 0
+
+def _align(size: int) -> int:
+    return (size + RECORD_ALIGN - 1) // RECORD_ALIGN * RECORD_ALIGN
+
+class ShmByteRing:
+    """
+    Variable size message ring shared between one producer and one consumer process,
+    used to hand encoded packets to a worker process without pickling them.
+
+        | counters (head, tail, ...) | record | record | ... | wrap | (free) |
+
+    A record is | length | frame_id | payload |, padded to 8 bytes. A record never straddles the end
+    of the region, the producer writes a wrap marker and starts over at offset 0 instead.
+    head / tail are monotonically increasing byte positions. A semaphore counts the published records,
+    which also orders the payload writes before the consumer reads.
+
+    put() never blocks, a packet that doesn't fit is dropped. With `keyframe` given, everything
+    after a drop is dropped up to the next keyframe, since the decoder couldn't use it anyway.
+
+    :param capacity: Size of the data region in bytes
+    """
+    def __init__(self, capacity=4 * 1024 * 1024):
+        self.capacity = _align(capacity)
+        self.shm = shared_memory.SharedMemory(create=True, size=HEADER_COUNTERS * 8 + self.capacity)
+        self.name = self.shm.name
+        self._map()
+        self.counters[:] = 0
+
+        self.items = multiprocessing.Semaphore(0)
+        self.dropping = False
+
+    def _map(self):
+        self.counters = np.ndarray((HEADER_COUNTERS,), dtype=np.int64, buffer=self.shm.buf)
+        self.data = self.shm.buf[HEADER_COUNTERS * 8:]
+
+    def _unmap(self):
+        self.counters = None
+        if self.data is not None:
+            self.data.release()
+        self.data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('counters', None)
+        state.pop('data', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map()
+
+    def put(self, frame_id: int, payload: bytes, keyframe: bool | None = None) -> bool:
+        """
+        Copy a packet into the ring.
+
+        :param keyframe: Whether the packet is a keyframe, None disables the drop-until-keyframe behaviour
+        :return: False if the packet was dropped
+        """
+        if self.counters[STOPPED]:
+            raise QueueStoppedError()
+
+        if self.dropping and keyframe is False:
+            self.counters[DROPPED] += 1
+            return False
+
+        size = _align(RECORD.size + len(payload))
+        tail = int(self.counters[TAIL])
+        offset = tail % self.capacity
+        contiguous = self.capacity - offset
+        needed = size if size <= contiguous else contiguous + size
+
+        # head only moves forward, a stale read just underestimates the free space
+        if self.capacity - (tail - int(self.counters[HEAD])) < needed:
+            self.counters[DROPPED] += 1
+            self.dropping = keyframe is not None
+            return False
+
+        if size > contiguous:
+            LENGTH.pack_into(self.data, offset, WRAP)
+            tail += contiguous
+            offset = 0
+
+        RECORD.pack_into(self.data, offset, len(payload), frame_id)
+        self.data[offset + RECORD.size:offset + RECORD.size + len(payload)] = payload
+        self.counters[TAIL] = tail + size
+        self.dropping = False
+        self.items.release()
+        return True
+
+    def get(self, timeout: float | None = None) -> tuple[int, bytes]:
+        """
+        Take the oldest packet.
+
+        :return: (frame_id, payload)
+        :raises queue.Empty: Nothing arrived within `timeout` seconds
+        :raises QueueStoppedError: The ring was stopped
+        """
+        if not self.items.acquire(timeout=timeout):
+            raise queue.Empty()
+        if self.counters[STOPPED]:
+            raise QueueStoppedError()
+
+        head = int(self.counters[HEAD])
+        offset = head % self.capacity
+        if LENGTH.unpack_from(self.data, offset)[0] == WRAP:
+            head += self.capacity - offset
+            offset = 0
+        length, frame_id = RECORD.unpack_from(self.data, offset)
+
+        payload = bytes(self.data[offset + RECORD.size:offset + RECORD.size + length])
+        self.counters[HEAD] = head + _align(RECORD.size + length)
+        return frame_id, payload
+
+    def qsize(self) -> int:
+        """Bytes waiting in the ring."""
+        return int(self.counters[TAIL] - self.counters[HEAD])
+
+    def stats(self) -> dict:
+        return {"bytes": self.qsize(), "capacity": self.capacity, "dropped": int(self.counters[DROPPED])}
+
+    def stop(self):
+        self.counters[STOPPED] = 1
+        self.items.release()  # Wake up a blocked consumer
+
+    def cleanup(self):
+        self._unmap()
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
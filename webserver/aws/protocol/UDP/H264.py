@@ -4,13 +4,17 @@ import os
 import struct
 import cv2
 import time
-from typing import List, Optional
+from typing import Optional
 import numpy as np
 from .base import BaseUDP
-from inference import ShmQueue
+from inference import ShmQueue, ShmByteRing
 from utils.logger import Log
+from utils.broadcast import BroadcastHub
+from utils.wire import WirePayload
+from consumers.detections import DetectionConsumer
 from constants import FFMPEG_DIR, INFERENCE_ENABLED
 from utils.ffmpeg_helper import get_decoder, is_keyframe
+from workers.decoder import forward_packets
 
 # Import ffmpeg
 if os.path.exists(FFMPEG_DIR):
@@ -19,20 +23,20 @@ import av
 from av.packet import Packet
 
 class H264_TO_JPG_PROTOCOL(BaseUDP):
-    def __init__(self, input_queue: ShmQueue | List[asyncio.Queue], decode_queue: asyncio.Queue, ordered_queue: asyncio.Queue,  inference_enabled = True):
+    def __init__(self, input_queue: ShmQueue | BroadcastHub, decode_queue: asyncio.Queue, ordered_queue: asyncio.Queue,  inference_enabled = True):
         super().__init__(inference_enabled)
 
         self.input_queue: Optional[ShmQueue] = None
-        self.frame_queues: Optional[list[asyncio.Queue]] = None
+        self.frame_hub: Optional[BroadcastHub] = None
 
         if self.inference_enabled:
             assert isinstance(input_queue, ShmQueue), \
                 "When inference is enabled, input_queue must be a ShmQueue instance."
             self.input_queue = input_queue
         else:
-            assert isinstance(input_queue, list) and all(isinstance(q, asyncio.Queue) for q in input_queue), \
-                "When inference is disabled, input_queue must be a list of asyncio.Queue instances."
-            self.frame_queues = input_queue
+            assert isinstance(input_queue, BroadcastHub), \
+                "When inference is disabled, input_queue must be a BroadcastHub instance."
+            self.frame_hub = input_queue
         
         assert isinstance(decode_queue, asyncio.Queue), \
             "decode_queue must be a asyncio.Queue instances."
@@ -46,24 +50,25 @@ class H264_TO_JPG_PROTOCOL(BaseUDP):
             self.ordered_queue.put_nowait((frame_id, full_frame))
 
     @staticmethod
-    async def decode(input_queue: ShmQueue | List[asyncio.Queue], decode_queue: asyncio.Queue, decoder_name: str, device_type: str | None = None):
+    async def decode(input_queue: ShmByteRing | BroadcastHub, decode_queue: asyncio.Queue, decoder_name: str, device_type: str | None = None):
         if INFERENCE_ENABLED:
-            assert isinstance(input_queue, ShmQueue), \
-                "When inference is enabled, input_queue must be a ShmQueue instance."
+            assert isinstance(input_queue, ShmByteRing), \
+                "When inference is enabled, input_queue must be the ShmByteRing of the decode worker."
             input_queue = input_queue
         else:
-            assert isinstance(input_queue, list) and all(isinstance(q, asyncio.Queue) for q in input_queue), \
-                "When inference is disabled, input_queue must be a list of asyncio.Queue instances."
-            frame_queues = input_queue
+            assert isinstance(input_queue, BroadcastHub), \
+                "When inference is disabled, input_queue must be a BroadcastHub instance."
+            frame_hub = input_queue
 
         assert isinstance(decode_queue, asyncio.Queue), "decode_queue must be a asyncio.Queue instances."
         
         loop = asyncio.get_event_loop()
 
-        if isinstance(input_queue, ShmQueue):
-            await H264_TO_JPG_PROTOCOL.__decode_to_shm(input_queue, decode_queue, loop, decoder_name, device_type)
-        elif isinstance(input_queue, list):
-            await H264_TO_JPG_PROTOCOL.__decode_to_frame(frame_queues, decode_queue, loop, decoder_name, device_type)
+        if isinstance(input_queue, ShmByteRing):
+            # Decoding into the inference input queue happens in the decode worker process
+            await forward_packets(decode_queue, input_queue)
+        elif isinstance(input_queue, BroadcastHub):
+            await H264_TO_JPG_PROTOCOL.__decode_to_frame(frame_hub, decode_queue, loop, decoder_name, device_type)
         else:
             raise ValueError("Input Queue not supported. Pass correct type of input_queue in H264_TO_JPG_PROTOCOL")
     
@@ -73,42 +78,7 @@ class H264_TO_JPG_PROTOCOL(BaseUDP):
         return timestamp_us, frame_type, packet_data[9:]   
     
     @staticmethod
-    async def __decode_to_shm(input_queue: ShmQueue, decode_queue: asyncio.Queue,  loop: asyncio.AbstractEventLoop, decoder_name: str, device_type: str | None):
-        if not INFERENCE_ENABLED:
-            raise ValueError("Inference must be enabled")
-
-        decoder = get_decoder(decoder_name, device_type)
-        decoder = get_decoder(decoder_name, device_type)
-        time_base = (Fraction(1, 30)) * 1_000_000 
-
-        while True:
-            try:
-                encoded_packet_bytes, frame_id = await decode_queue.get()
-                timestamp_us, frame_type, packet_data = H264_TO_JPG_PROTOCOL.__unpack_packet(encoded_packet_bytes)
-
-                packet = Packet(packet_data)
-                packet.is_keyframe = True if frame_type == 1 else False
-                packet.pts = round(timestamp_us / time_base)
-                decoded_video_frames = await loop.run_in_executor(None, lambda: decoder.decode(packet)) 
-
-                if len(decoded_video_frames) <= 0:
-                    continue
-                
-                decoded_video_frame = decoded_video_frames[0]
-                decoded_frame = decoded_video_frame.to_ndarray()
-                bgr_frame = cv2.cvtColor(decoded_frame, cv2.COLOR_YUV2BGR_I420)
-
-                await loop.run_in_executor(None, lambda: input_queue.put(bgr_frame, frame_id))
-                #await asyncio.sleep(0)
-            except asyncio.CancelledError:
-                break
-            except KeyboardInterrupt:
-                break
-            except Exception as e:
-                    Log.exception(f"error at decode_video: {e}")
-
-    @staticmethod
-    async def __decode_to_frame(frame_queues: List[asyncio.Queue], decode_queue: asyncio.Queue,  loop: asyncio.AbstractEventLoop, decoder_name: str, device_type: str | None):
+    async def __decode_to_frame(frame_hub: BroadcastHub, decode_queue: asyncio.Queue,  loop: asyncio.AbstractEventLoop, decoder_name: str, device_type: str | None):
         if INFERENCE_ENABLED:
             raise ValueError("Inference must be disabled")
         
@@ -139,11 +109,9 @@ class H264_TO_JPG_PROTOCOL(BaseUDP):
                     continue
                 
                 frame_bytes = jpeg_encoded.tobytes()
-                timestamped_frame = (time.time(), frame_bytes)
+                timestamped_frame = (time.time(), WirePayload(frame_bytes))
 
-                for q in frame_queues:
-                    if not q.full():
-                        q.put_nowait(timestamped_frame)
+                frame_hub.publish(timestamped_frame)
                 
                 #await asyncio.sleep(0)
             except asyncio.CancelledError:
@@ -155,11 +123,11 @@ class H264_TO_JPG_PROTOCOL(BaseUDP):
 
 
 class H264_TO_H264_PROTOCOL(BaseUDP):
-    def __init__(self, input_queue: ShmQueue | List[asyncio.Queue], decode_queue: asyncio.Queue | None, ordered_queue: asyncio.Queue,  inference_enabled = True):
+    def __init__(self, input_queue: ShmQueue | BroadcastHub, decode_queue: asyncio.Queue | None, ordered_queue: asyncio.Queue,  inference_enabled = True):
         super().__init__(inference_enabled)
         
         self.input_queue: Optional[ShmQueue] = None
-        self.frame_queues: Optional[list[asyncio.Queue]] = None
+        self.frame_hub: Optional[BroadcastHub] = None
         self.ordered_queue = ordered_queue
 
         if self.inference_enabled:
@@ -171,9 +139,9 @@ class H264_TO_H264_PROTOCOL(BaseUDP):
             "decode_queue must be a asyncio.Queue instances."
             self.decode_queue = decode_queue
         else:
-            assert isinstance(input_queue, list) and all(isinstance(q, asyncio.Queue) for q in input_queue), \
-                "When inference is disabled, input_queue must be a list of asyncio.Queue instances."
-            self.frame_queues = input_queue
+            assert isinstance(input_queue, BroadcastHub), \
+                "When inference is disabled, input_queue must be a BroadcastHub instance."
+            self.frame_hub = input_queue
 
         assert isinstance(ordered_queue, asyncio.Queue), "ordered_queue must be a asyncio.Queue instances."
 
@@ -201,50 +169,14 @@ class H264_TO_H264_PROTOCOL(BaseUDP):
             self.ordered_queue.put_nowait((frame_id, full_frame))
 
     @staticmethod
-    async def decode(decode_queue: asyncio.Queue , input_queue: ShmQueue, decoder_name: str, device_type: str | None = None):
+    async def decode(decode_queue: asyncio.Queue , packet_ring: ShmByteRing, detections: DetectionConsumer | None = None):
+        """
+        Hand the packets over to the decode worker process, which writes the decoded frames into the inference input queue.
+        """
         assert isinstance(decode_queue, asyncio.Queue), "decode_queue must be a asyncio.Queue instances."
-        assert isinstance(input_queue, ShmQueue), "When inference is enabled, input_queue must be a ShmQueue instance."
+        assert isinstance(packet_ring, ShmByteRing), "packet_ring must be a ShmByteRing instance."
 
         if not INFERENCE_ENABLED:
             raise ValueError("Inference must be enabled")
 
-
-        decoder = get_decoder(decoder_name, device_type)
-        Log.info(f"using {decoder.name}")
-        time_base = (Fraction(1, 30)) * 1_000_000 
-        loop = asyncio.get_event_loop()
-
-        while True:
-            try:
-                encoded_packet_bytes, frame_id = await decode_queue.get()
-                timestamp_us, frame_type, packet_data = H264_TO_H264_PROTOCOL.__unpack_packet(encoded_packet_bytes)
-
-                packet = Packet(packet_data)
-                packet.is_keyframe = True if frame_type == 1 else False
-                packet.pts = round(timestamp_us / time_base)
-
-                #start = time.perf_counter()
-                decoded_video_frames = await loop.run_in_executor(None, lambda: decoder.decode(packet)) 
-                #print(f"dec: {time.perf_counter() - start:.4f}s")
-
-                if len(decoded_video_frames) <= 0:
-                    continue
-
-                print(frame_id)
-                
-                decoded_video_frame = decoded_video_frames[0]
-                decoded_frame = decoded_video_frame.to_ndarray()
-                bgr_frame = cv2.cvtColor(decoded_frame, cv2.COLOR_YUV2BGR_I420)
-
-                await loop.run_in_executor(None, lambda: input_queue.put(bgr_frame, frame_id))
-                await asyncio.sleep(0)
-            except asyncio.CancelledError:
-                break
-            except KeyboardInterrupt:
-                break
-            except Exception as e:
-                    Log.exception(f"error at decode_video: {e}")
-        
-
-
-
+        await forward_packets(decode_queue, packet_ring, detections)
@@ -1,27 +1,29 @@
 import asyncio
 import cv2
 import time
-from typing import List, Optional
+from typing import Optional
 import numpy as np
 from .base import BaseUDP
 from inference import ShmQueue
 from utils.logger import Log
+from utils.broadcast import BroadcastHub
+from utils.wire import WirePayload
 
 class JPG_TO_JPG_PROTOCOL(BaseUDP):
-    def __init__(self, input_queue: ShmQueue | List[asyncio.Queue], inference_enabled = True ):
+    def __init__(self, input_queue: ShmQueue | BroadcastHub, inference_enabled = True ):
         super().__init__(inference_enabled)
 
         self.input_queue: Optional[ShmQueue] = None
-        self.frame_queues: Optional[list[asyncio.Queue]] = None
+        self.frame_hub: Optional[BroadcastHub] = None
 
         if inference_enabled:
             assert isinstance(input_queue, ShmQueue), \
                 "When inference is enabled, input_queue must be a ShmQueue instance."
             self.input_queue = input_queue
         else:
-            assert isinstance(input_queue, list) and all(isinstance(q, asyncio.Queue) for q in input_queue), \
-                "When inference is disabled, input_queue must be a list of asyncio.Queue instances."
-            self.frame_queues = input_queue
+            assert isinstance(input_queue, BroadcastHub), \
+                "When inference is disabled, input_queue must be a BroadcastHub instance."
+            self.frame_hub = input_queue
 
     def handle_received_frame(self, full_frame: bytes, frame_id: int):
         # Decode frame
@@ -38,17 +40,15 @@ class JPG_TO_JPG_PROTOCOL(BaseUDP):
             _, buffer = cv2.imencode(".jpg", frame)
             frame_bytes = buffer.tobytes()
 
-            timestamped_frame = (time.time(), frame_bytes)
-            for q in self.frame_queues:
-                if not q.full():
-                    q.put_nowait(timestamped_frame)
+            timestamped_frame = (time.time(), WirePayload(frame_bytes))
+            self.frame_hub.publish(timestamped_frame)
 
 class JPG_TO_H264_PROTOCOL(BaseUDP):
     def __init__(self, input_queue: ShmQueue | asyncio.Queue, ordered_queue: asyncio.Queue, inference_enabled = True ):
         super().__init__(inference_enabled)
 
         self.input_queue: Optional[ShmQueue] = None
-        self.frame_queues: Optional[list[asyncio.Queue]] = None
+        self.frame_hub: Optional[BroadcastHub] = None
         self.ordered_queue = ordered_queue
 
         if inference_enabled:
@@ -3,8 +3,9 @@ import subprocess
 import socket
 import struct
 import time
+from collections import deque
 from zlib import crc32
-from typing import Any, Dict, Set
+from typing import Any
 from utils.logger import Log
 import platform
 from constants import protocol_closed
@@ -14,25 +15,168 @@ START_MARKER = b'\x01\x02\x7F\xED'
 END_MARKER = b'\x03\x04\x7F\xED'
 HEADER_FORMAT = "!4s I 3s B B H I"  # Updated header format
 HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+HEADER = struct.Struct(HEADER_FORMAT)
+
+MAX_UDP_PACKET_SIZE = 1450  # Datagram size of the Pi sender
+MAX_PAYLOAD_SIZE = MAX_UDP_PACKET_SIZE - HEADER_SIZE - len(END_MARKER)  # Every chunk but the last one of a frame is this long
+MAX_CHUNKS = 255            # total_chunks is a single byte
+EMPTY_BITMAP = bytes(32)    # One bit per chunk
 
 ACK_MARKER    = b'\x05\x06\x7F\xED'
 ACK_FORMAT    = "!4s 3s B"       # | 4-byte marker | 3-byte frame_id | 1-byte chunk_index |
 ACK_SIZE      = struct.calcsize(ACK_FORMAT)
+ACK           = struct.Struct(ACK_FORMAT)
+
+KEYFRAME_MARKER = b'\x07\x08\x7F\xED'  # Asks the sender to encode its next frame as a keyframe
+
+class FrameReassembler:
+    """
+    Put the chunks of the frames back together in a fixed pool of preallocated frame buffers.
+
+    Chunk `i` of a frame is written in place at `i * MAX_PAYLOAD_SIZE` of the buffer the frame holds, a bitmap
+    per buffer tells which chunks arrived, so a datagram costs a header unpack, a crc32 and one copy, whatever
+    the number of frames in progress. Frames are kept in arrival order of their first chunk, expiring the ones
+    older than `timeout` only looks at the oldest. When every buffer is in use the oldest frame is dropped.
+
+    The ids of the last `history` completed frames are kept, so a retransmitted chunk of a frame that is already
+    out (its ACK got lost) is acknowledged again instead of starting the frame over.
+
+    :param size: Number of frame buffers, frames in progress at the same time
+    :param timeout: Seconds a frame may take to complete
+    :param history: Completed frame ids remembered
+    """
+    def __init__(self, size=16, timeout=0.5, history=64):
+        self.size = size
+        self.timeout = timeout
+        self.history = history
+        self.buffers = [bytearray(MAX_CHUNKS * MAX_PAYLOAD_SIZE) for _ in range(size)]
+        self.bitmaps = [bytearray(32) for _ in range(size)]
+        self.frame_ids = [-1] * size        # Frame in every buffer, -1 when free
+        self.totals = [0] * size
+        self.received = [0] * size
+        self.lengths = [0] * size           # Length of the last chunk, known once it arrived
+        self.free = list(range(size))
+        self.in_progress: dict[int, int] = {}                   # frame_id -> buffer
+        self.started: deque[tuple[float, int, int]] = deque()   # (start, frame_id, buffer), oldest first
+        self.completed = [-1] * history
+        self.expired = 0
+
+    def reset(self):
+        for frame_id in list(self.in_progress):
+            self.__release(frame_id)
+        self.started.clear()
+        self.completed = [-1] * self.history
+
+    def add(self, data: bytes | memoryview, now: float) -> tuple[bytes, int, bytes | None]:
+        """
+        Take one datagram.
+
+        :param now: time.monotonic() of its arrival
+        :return: (ACK for the sender, frame_id, the complete frame once its last chunk arrived else None)
+        :raise ValueError: Malformed datagram
+        """
+        self.__expire(now)
+
+        view = memoryview(data)
+        if len(view) < HEADER_SIZE + len(END_MARKER):
+            raise ValueError("Packet too small")
+        if view[-len(END_MARKER):] != END_MARKER:
+            raise ValueError("Invalid end marker")
+
+        start_marker, _, frame_id_bytes, total_chunks, chunk_index, chunk_length, checksum = HEADER.unpack_from(view)
+        if start_marker != START_MARKER:
+            raise ValueError("Invalid start marker")
+        if chunk_length != len(view) - HEADER_SIZE - len(END_MARKER):
+            raise ValueError("Invalid payload length")
+        if chunk_index >= total_chunks:
+            raise ValueError("Invalid chunk index")
+        if chunk_index < total_chunks - 1 and chunk_length != MAX_PAYLOAD_SIZE:
+            raise ValueError("Invalid chunk size")
+
+        frame_id = int.from_bytes(frame_id_bytes, 'big')
+        ack = ACK.pack(ACK_MARKER, frame_id_bytes, chunk_index)
+        payload = view[HEADER_SIZE:HEADER_SIZE + chunk_length]
+
+        # Validate checksum (to ensure integrity of the payload)
+        if crc32(payload) != checksum:
+            Log.warning(f"Checksum mismatch for {frame_id}, chunk {chunk_index}")
+
+        if self.completed[frame_id % self.history] == frame_id:
+            return ack, frame_id, None
+
+        buffer = self.in_progress.get(frame_id)
+        if buffer is None:
+            buffer = self.__acquire(frame_id, total_chunks, now)
+        elif self.totals[buffer] != total_chunks:
+            raise ValueError("Invalid total chunks")
+
+        bitmap = self.bitmaps[buffer]
+        bit = 1 << (chunk_index & 7)
+        if bitmap[chunk_index >> 3] & bit:
+            return ack, frame_id, None
+        bitmap[chunk_index >> 3] |= bit
+
+        offset = chunk_index * MAX_PAYLOAD_SIZE
+        self.buffers[buffer][offset:offset + chunk_length] = payload
+        if chunk_index == total_chunks - 1:
+            self.lengths[buffer] = chunk_length
+        self.received[buffer] += 1
+
+        if self.received[buffer] < total_chunks:
+            return ack, frame_id, None
+
+        # The single copy, queues downstream keep the frame after its buffer is reused
+        full_frame = bytes(memoryview(self.buffers[buffer])[:(total_chunks - 1) * MAX_PAYLOAD_SIZE + self.lengths[buffer]])
+        self.__release(frame_id)
+        self.completed[frame_id % self.history] = frame_id
+        return ack, frame_id, full_frame
+
+    def __acquire(self, frame_id: int, total_chunks: int, now: float) -> int:
+        if not self.free:
+            # Every buffer in use, make room by dropping the oldest frame
+            while not self.free:
+                _, oldest, buffer = self.started.popleft()
+                if self.frame_ids[buffer] == oldest:
+                    Log.warning(f"Frame {oldest} dropped, no free reassembly buffer")
+                    self.__release(oldest)
+
+        buffer = self.free.pop()
+        self.bitmaps[buffer][:] = EMPTY_BITMAP
+        self.frame_ids[buffer] = frame_id
+        self.totals[buffer] = total_chunks
+        self.received[buffer] = 0
+        self.in_progress[frame_id] = buffer
+        self.started.append((now, frame_id, buffer))
+        return buffer
+
+    def __release(self, frame_id: int):
+        buffer = self.in_progress.pop(frame_id)
+        self.frame_ids[buffer] = -1
+        self.free.append(buffer)
+
+    def __expire(self, now: float):
+        started = self.started
+        while started and now - started[0][0] > self.timeout:
+            _, frame_id, buffer = started.popleft()
+            # Completed frames leave their entry behind, the buffer may hold a newer frame by now
+            if self.frame_ids[buffer] == frame_id:
+                Log.warning(f"Frame {frame_id} timeout. Discarded")
+                self.__release(frame_id)
+                self.expired += 1
 
 class BaseUDP(asyncio.DatagramProtocol):
     def __init__(self, inference_enabled=True):
         self.inference_enabled = inference_enabled
         self.transport = None
-        self.frames_in_progress = {}
-        self._received_chunks: Dict[int, Set[int]] = {}
         self.loop = asyncio.get_event_loop()
         self.timeout = 0.5
+        self.reassembler = FrameReassembler(timeout=self.timeout)
         self.is_stopped = False
+        self.sender: tuple[str | Any, int] | None = None
 
     def reset(self):
         """Reset internal state to initial values."""
-        self.frames_in_progress.clear()  # Clear frames in progress
-        self._received_chunks.clear()  # Clear the received chunks map
+        self.reassembler.reset()
         Log.info("BaseUDP state has been reset.")
     
     def stop(self):
@@ -79,100 +223,44 @@ class BaseUDP(asyncio.DatagramProtocol):
         return (server_timestamp - client_timestamp) % 0x100000000  # 2^32
 
     def datagram_received(self, data: bytes, addr: tuple[str | Any, int]):
+        if self.is_stopped:
+            return
+        self.__receive(data, addr, time.monotonic())
+
+    def datagrams_received(self, slots: list[memoryview], lengths: list[int], addrs: list[tuple[str | Any, int]], count: int):
+        """
+        Batched counterpart of datagram_received (see BatchedDatagramTransport), datagram i is slots[i][:lengths[i]].
+        The slots are reused once this returns.
+        """
+        if self.is_stopped:
+            return
+        now = time.monotonic()
+        for i in range(count):
+            self.__receive(slots[i][:lengths[i]], addrs[i], now)
+
+    def __receive(self, data: bytes | memoryview, addr: tuple[str | Any, int], now: float):
         try:
-            if self.is_stopped:
-                return
-            
-            self.cleanup_old_frames(time.time())
-
-            if len(data) < HEADER_SIZE + len(END_MARKER):
-                raise ValueError("Packet too small")
-
-            # Extract header and payload
-            header = data[:HEADER_SIZE]
-            payload = data[HEADER_SIZE:-len(END_MARKER)]
-            end_marker = data[-len(END_MARKER):]
-
-            # Validate end marker
-            if end_marker != END_MARKER:
-                raise ValueError("Invalid end marker")
-
-            # Unpack the header using the updated HEADER_FORMAT
-            start_marker, timestamp, frame_id, total_chunks, chunk_index, chunk_length, checksum = struct.unpack(HEADER_FORMAT, header)
-            frame_id = int.from_bytes(frame_id, byteorder='big')
-
-            # Validate start marker
-            if start_marker != START_MARKER:
-                raise ValueError("Invalid start marker")
-            
-            if chunk_length != len(payload):
-                raise ValueError("Invalid payload length")
-
-            # Validate checksum (to ensure integrity of the payload)
-            if crc32(payload) != checksum:
-                Log.warning(f"Checksum mismatch for {frame_id}, chunk {chunk_index}")
-
-            server_time_ms = int(time.time() * 1000) % 0x100000000
-            elapsed_time_sec = self.calculate_elapsed_time_ms(timestamp, server_time_ms) / 1000.0
-
-            #print(f"took ({elapsed_time_sec:.3f} sec)")
-            
-            # Debugging: print out the unpacked header data
-            '''
-            print(f"Start Marker: {start_marker}")
-            print(f"Timestamp: {timestamp}")
-            print(f"Frame ID (int): {frame_id}")
-            print(f"Total Chunks: {total_chunks}")
-            print(f"Chunk Index: {chunk_index}")
-            print(f"Chunk Length: {chunk_length}")
-            print(f"Checksum: {checksum}")
-            print(f"End marker: {end_marker}")
-            '''
-
-            ack = struct.pack(ACK_FORMAT, ACK_MARKER,frame_id.to_bytes(3, 'big'), chunk_index)
-            self.transport.sendto(ack, addr)
+            ack, frame_id, full_frame = self.reassembler.add(data, now)
 
-            seen = self._received_chunks.setdefault(frame_id, set())
-            if chunk_index in seen:
-                return
-            # first time: mark as seen
-            seen.add(chunk_index)
-
-            if frame_id not in self.frames_in_progress:
-                self.frames_in_progress[frame_id] = {
-                    'chunks': [None] * total_chunks,
-                    'received': 0,
-                    'start_time': time.time(),
-                }
-
-            frame_entry = self.frames_in_progress[frame_id]
-            if frame_entry['chunks'][chunk_index] is None:
-                frame_entry['chunks'][chunk_index] = payload
-                frame_entry['received'] += 1
-
-            if frame_entry['received'] == total_chunks:
-                # All chunks received
-                full_frame = b"".join(frame_entry['chunks'])
-                # Cleanup
-                del self.frames_in_progress[frame_id]
+            self.transport.sendto(ack, addr)
+            self.sender = addr
 
+            if full_frame is not None:
                 self.handle_received_frame(full_frame, frame_id)
         except asyncio.CancelledError:
             return
         except Exception as e:
             Log.exception(f"Error in datagram_received: {e}")
     
+    def request_keyframe(self):
+        """Ask the sender (the last address frames came from) for a keyframe."""
+        if self.transport is not None and self.sender is not None and not self.is_stopped:
+            self.transport.sendto(KEYFRAME_MARKER, self.sender)
+
     def handle_received_frame(self, full_frame: bytes, frame_id: int = -1):
         """Process the received frame and reassemble if all chunks are received"""
         raise NotImplementedError("handle_received_frame should be implemented by subclasses")
 
-    def cleanup_old_frames(self, now):
-        expired_ids = [fid for fid, entry in self.frames_in_progress.items() if now - entry['start_time'] > self.timeout]
-        for fid in expired_ids:
-            Log.warning(f"Frame {fid} timeout. Discarded")
-            del self.frames_in_progress[fid]
-            self._received_chunks.pop(fid, None)
-
     def error_received(self, exc: Exception):
         Log.exception(f"Error received: {exc}")
 
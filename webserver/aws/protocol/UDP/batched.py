@@ -0,0 +1,110 @@
+import asyncio
+import socket
+from typing import Any, Callable
+from utils.logger import Log
+from .base import BaseUDP
+
+SLOT_SIZE = 2048  # Larger than any datagram of the Pi sender, a longer one is cut and fails the end marker check
+
+class BatchedDatagramTransport(asyncio.DatagramTransport):
+    """
+    Datagram transport that drains its socket in batches instead of one protocol callback per datagram.
+
+    Once the socket is readable up to `batch_size` datagrams are read with recvfrom_into into a preallocated
+    ring of slots, then handed to BaseUDP.datagrams_received in one call. Python has no recvmmsg, so it is still
+    a syscall per datagram, but no event loop iteration, callback or bytes object per datagram.
+    A slot is only valid during that call, the reassembler copies the chunks out.
+
+    ACKs and keyframe requests are sent right away, a send that would block is dropped: the sender retransmits
+    a chunk whose ACK doesn't come.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, sock: socket.socket, protocol: BaseUDP, batch_size=64):
+        super().__init__({'socket': sock, 'sockname': sock.getsockname()})
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+        self.batch_size = batch_size
+        self.ring = bytearray(batch_size * SLOT_SIZE)
+        ring = memoryview(self.ring)
+        self.slots = [ring[i * SLOT_SIZE:(i + 1) * SLOT_SIZE] for i in range(batch_size)]
+        self.lengths = [0] * batch_size
+        self.addrs: list[tuple[str | Any, int] | None] = [None] * batch_size
+        self.closing = False
+        self.dropped_sends = 0
+
+        # First, so a loop without readers fails before the protocol is connected
+        self.loop.add_reader(self.sock.fileno(), self.__read_ready)
+        self.protocol.connection_made(self)
+
+    def __read_ready(self):
+        count = 0
+        try:
+            while count < self.batch_size:
+                self.lengths[count], self.addrs[count] = self.sock.recvfrom_into(self.slots[count])
+                count += 1
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as exc:
+            self.protocol.error_received(exc)
+
+        # A full batch returns to the loop anyway, the reader fires again while datagrams are left
+        if count:
+            self.protocol.datagrams_received(self.slots, self.lengths, self.addrs, count)
+
+    def sendto(self, data: bytes, addr: tuple[str | Any, int] | None = None):
+        if self.closing:
+            return
+        try:
+            self.sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            self.dropped_sends += 1
+        except OSError as exc:
+            self.protocol.error_received(exc)
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def close(self):
+        if self.closing:
+            return
+        self.closing = True
+        self.loop.remove_reader(self.sock.fileno())
+        self.loop.call_soon(self.__connection_lost)
+
+    def abort(self):
+        self.close()
+
+    def __connection_lost(self):
+        try:
+            self.protocol.connection_lost(None)
+        finally:
+            self.sock.close()
+
+async def create_batched_endpoint(protocol_factory: Callable[[], BaseUDP], local_addr: tuple[str, int],
+                                  batch_size=64) -> tuple[asyncio.DatagramTransport, BaseUDP]:
+    """
+    Counterpart of loop.create_datagram_endpoint for the ingest listener, the protocol gets its datagrams in batches.
+
+    Loops without add_reader (the proactor loop on Windows) get a plain create_datagram_endpoint instead.
+
+    :param batch_size: Max datagrams read per wakeup
+    :return: (transport, protocol) like create_datagram_endpoint
+    """
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.bind(local_addr)
+    except OSError:
+        sock.close()
+        raise
+
+    protocol = protocol_factory()
+    try:
+        transport = BatchedDatagramTransport(loop, sock, protocol, batch_size)
+    except NotImplementedError:
+        sock.close()
+        Log.warning(f"{type(loop).__name__} can't watch sockets, UDP datagrams are received one by one")
+        return await loop.create_datagram_endpoint(lambda: protocol, local_addr=local_addr)
+    Log.info(f"Batched UDP receiver on {local_addr[0]}:{local_addr[1]}, batch of {batch_size}")
+    return transport, protocol
@@ -1,8 +1,9 @@
 from .UDP.base import BaseUDP
+from .UDP.batched import create_batched_endpoint
 from .TCP.base import BaseTCP
 from .UDP.JPG import JPG_TO_JPG_PROTOCOL, JPG_TO_H264_PROTOCOL
 from .UDP.H264 import H264_TO_JPG_PROTOCOL, H264_TO_H264_PROTOCOL
 from .TCP.JPG import JPG_TO_JPG_TCP, JPG_TO_H264_TCP
 from .TCP.H264 import H264_TO_JPG_TCP, H264_TO_H264_TCP
 
-__all__ = ['BaseUDP', 'JPG_TO_JPG_PROTOCOL', 'JPG_TO_H264_PROTOCOL', 'H264_TO_JPG_PROTOCOL', 'H264_TO_H264_PROTOCOL', 'BaseTCP', 'JPG_TO_JPG_TCP', 'JPG_TO_H264_TCP', 'H264_TO_JPG_TCP', 'H264_TO_H264_TCP']
+__all__ = ['BaseUDP', 'create_batched_endpoint', 'JPG_TO_JPG_PROTOCOL', 'JPG_TO_H264_PROTOCOL', 'H264_TO_JPG_PROTOCOL', 'H264_TO_H264_PROTOCOL', 'BaseTCP', 'JPG_TO_JPG_TCP', 'JPG_TO_H264_TCP', 'H264_TO_JPG_TCP', 'H264_TO_H264_TCP']
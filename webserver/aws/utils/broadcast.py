@@ -0,0 +1,207 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Callable
+from utils.wire import WirePayload
+from utils.packet_queue import ParameterSetCache
+
+class BroadcastHub:
+    """
+    Fan viewer payloads out to any number of subscribers: one ring of the last `size` items,
+    every subscriber reads it through its own cursor.
+
+    publish() stores a single reference and wakes the waiting subscribers through one shared future,
+    so its cost doesn't depend on the number of viewers, and a stalled viewer holds no backlog.
+    A subscriber that falls more than `max_lag` items behind, or whose next item is older than
+    `max_age` seconds, skips forward to the newest keyframe. Without a newer keyframe in the ring
+    it skips everything up to the next one.
+
+    The items since the newest keyframe (the current GOP) are kept apart from the ring, a new subscriber
+    replays them first so it can decode right away instead of waiting for the next keyframe. When the GOP
+    is longer than `max_burst`, and an encoder is attached through `keyframe_requester`, it is asked for
+    an IDR frame instead, which is also what a subscriber that has to wait for a keyframe does.
+
+    :param size: Number of items kept in the ring
+    :param max_lag: Items a subscriber may fall behind before it skips forward
+    :param max_age: Seconds an item may wait for a subscriber before it skips forward
+    :param gop_size: Max items kept for joining subscribers, a longer GOP isn't replayed
+    :param max_burst: Longest GOP replayed to a new subscriber when a keyframe can be requested instead
+    :param keyframe_interval: Min seconds between two keyframe requests
+    """
+    def __init__(self, size=64, max_lag=16, max_age=0.2, gop_size=300, max_burst=30, keyframe_interval=0.5):
+        self.size = size
+        self.max_lag = min(max_lag, size)
+        self.max_age = max_age
+        self.gop_size = gop_size
+        self.max_burst = max_burst
+        self.keyframe_interval = keyframe_interval
+        self.items: list[tuple[float, Any] | None] = [None] * size
+        self.keyframes = [False] * size
+        self.head = 0               # Sequence number of the next published item
+        self.last_keyframe = -1     # Sequence number of the newest keyframe
+        self.gop: list[tuple[float, Any]] | None = None  # Newest keyframe and the items after it, None once too long
+        self.subscribers: set[Subscription] = set()
+        self.waiter: asyncio.Future | None = None
+
+        self.parameter_sets: ParameterSetCache | None = None
+        """Set for H.264 hubs, puts the SPS / PPS back in front of the keyframe a subscriber joins on"""
+        self.keyframe_requester: Callable[[], None] | None = None
+        """Asks the encoder feeding the hub for an IDR frame, None when the keyframes can't be forced"""
+        self.keyframe_requested = 0.0
+        self.keyframe_requests = 0
+
+    def publish(self, item: tuple[float, Any], keyframe=True):
+        """
+        Add a (timestamp, payload) item.
+
+        :param keyframe: Whether a subscriber can start decoding at this item. Every JPEG is one,
+                         H.264 packets pass is_keyframe_packet, side channel messages (detections) pass False
+        """
+        index = self.head % self.size
+        self.items[index] = item
+        self.keyframes[index] = keyframe
+        if keyframe:
+            self.last_keyframe = self.head
+            self.gop = [self.__join_item(item)]
+        elif self.gop is not None:
+            self.gop.append(item)
+            if len(self.gop) > self.gop_size:
+                self.gop = None
+        self.head += 1
+
+        if self.waiter is not None:
+            if not self.waiter.done():
+                self.waiter.set_result(None)
+            self.waiter = None
+
+    def __join_item(self, item: tuple[float, Any]) -> tuple[float, Any]:
+        if self.parameter_sets is None or not isinstance(item[1], WirePayload):
+            return item
+        packet_data = self.parameter_sets.complete(item[1].data)
+        return item if packet_data is item[1].data else (item[0], WirePayload(packet_data, item[1].frame_id))
+
+    def request_keyframe(self) -> bool:
+        """
+        Ask the encoder for an IDR frame, at most once every `keyframe_interval` seconds.
+
+        :return: False when no encoder is attached, the next keyframe comes whenever the source sends one
+        """
+        if self.keyframe_requester is None:
+            return False
+
+        now = time.monotonic()
+        if now - self.keyframe_requested >= self.keyframe_interval:
+            self.keyframe_requested = now
+            self.keyframe_requests += 1
+            self.keyframe_requester()
+        return True
+
+    async def wait(self):
+        """Wait for the next publish()."""
+        if self.waiter is None:
+            self.waiter = asyncio.get_event_loop().create_future()
+        # A cancelled subscriber must not cancel the future the others wait on
+        await asyncio.shield(self.waiter)
+
+    def subscribe(self) -> 'Subscription':
+        subscription = Subscription(self)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: 'Subscription'):
+        self.subscribers.discard(subscription)
+
+    def metrics(self) -> dict:
+        return {
+            "published": self.head,
+            "gop": len(self.gop) if self.gop is not None else None,
+            "keyframe_requests": self.keyframe_requests,
+            "subscribers": [subscription.metrics() for subscription in self.subscribers],
+        }
+
+class Subscription:
+    """
+    Cursor of one viewer into a BroadcastHub. Starts with a replay of the current GOP,
+    or at the next published keyframe when there is none to replay.
+    """
+    def __init__(self, hub: BroadcastHub):
+        self.hub = hub
+        self.cursor = hub.head
+        self.backlog: deque[tuple[float, Any]] = deque()
+        self.delivered = 0
+        self.skipped = 0
+        self.skips = 0
+        self.replayed = False   # Whether the last item returned came from the GOP replay, it is as old as its GOP
+
+        gop = hub.gop
+        requested = (gop is None or len(gop) > hub.max_burst) and hub.request_keyframe()
+        if gop and not requested:
+            self.backlog.extend(gop)
+        self.waiting_keyframe = not self.backlog
+
+    def lag(self) -> int:
+        """Items published but not read yet."""
+        return self.hub.head - self.cursor + len(self.backlog)
+
+    async def get(self) -> tuple[float, Any]:
+        """
+        Next (timestamp, payload) item, skipping forward when the subscriber fell behind.
+        """
+        while True:
+            item = self.get_nowait()
+            if item is not None:
+                return item
+            await self.hub.wait()
+
+    def get_nowait(self) -> tuple[float, Any] | None:
+        """
+        Like get(), None when no item is ready yet.
+        """
+        if self.backlog:
+            self.delivered += 1
+            self.replayed = True
+            return self.backlog.popleft()
+
+        self.replayed = False
+        hub = self.hub
+        while self.cursor < hub.head:
+            self.__catch_up()
+            if self.cursor >= hub.head:
+                break
+
+            index = self.cursor % hub.size
+            self.cursor += 1
+            if self.waiting_keyframe:
+                if not hub.keyframes[index]:
+                    self.skipped += 1
+                    continue
+                self.waiting_keyframe = False
+
+            self.delivered += 1
+            return hub.items[index]
+        return None
+
+    def __catch_up(self):
+        hub = self.hub
+        lag = self.lag()
+        if lag <= hub.max_lag and time.time() - hub.items[self.cursor % hub.size][0] <= hub.max_age:
+            return
+
+        if hub.last_keyframe >= max(self.cursor, hub.head - hub.size):
+            target = hub.last_keyframe
+        else:
+            # No keyframe to resume from yet, drop everything up to the next one
+            target = hub.head
+            self.waiting_keyframe = True
+            hub.request_keyframe()
+
+        if target > self.cursor:
+            self.skipped += target - self.cursor
+            self.skips += 1
+            self.cursor = target
+
+    def metrics(self) -> dict:
+        return {"lag": self.lag(), "delivered": self.delivered, "skipped": self.skipped, "skips": self.skips}
+
+    def close(self):
+        self.hub.unsubscribe(self)
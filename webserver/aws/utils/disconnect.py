@@ -0,0 +1,53 @@
+import asyncio
+from typing import Any, Callable
+from blacksheep import Request, WebSocket, WebSocketDisconnectError
+from utils.logger import Log
+
+def cancel_on_disconnect(request: Request) -> asyncio.Task:
+    """
+    Cancel the calling task, the send loop of a streaming response, once its client disconnects.
+
+    The server reports the disconnect on the ASGI receive channel, a watcher task waits on it instead of
+    the send loop polling request.is_disconnected() every frame. The send loop needs no pacing either:
+    every send awaits the transport drain, which blocks while the write buffer is above its high watermark,
+    so a slow client only holds up its own loop and its hub subscription skips forward.
+
+    :return: The watcher, cancel it once the send loop ends
+    """
+    sender = asyncio.current_task()
+
+    async def watch():
+        while True:
+            message = await request.content.receive()
+            if message["type"] == "http.disconnect":
+                Log.info("The request is disconnected!")
+                sender.cancel()
+                return
+
+    return asyncio.create_task(watch())
+
+def cancel_on_ws_disconnect(websocket: WebSocket, on_message: Callable[[dict[str, Any]], None] | None = None) -> asyncio.Task:
+    """
+    WebSocket counterpart of cancel_on_disconnect, the watcher also reads the messages of the client.
+
+    :param on_message: Called with every `websocket.receive` message, they are dropped without it
+    :return: The watcher, cancel it once the send loop ends
+    """
+    sender = asyncio.current_task()
+
+    async def watch():
+        try:
+            while True:
+                message = await websocket.receive()
+                if on_message is not None:
+                    on_message(message)
+        except WebSocketDisconnectError:
+            Log.info("The websocket is disconnected!")
+            sender.cancel()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            Log.exception(f"Error reading websocket: {e}")
+            sender.cancel()
+
+    return asyncio.create_task(watch())
@@ -3,6 +3,7 @@ import cv2
 import os
 import numpy as np
 import time
+from dataclasses import dataclass
 from typing import List
 from inference import ShmQueue
 from utils.logger import Log
@@ -23,13 +24,29 @@ class EncodersProperties():
     frame_rate: int
     enc_options: dict
 
-def h264_nvenc():
+@dataclass
+class Rendition:
+    """
+    One stream of the outgoing simulcast ladder.
+
+    :param name: Name viewers subscribe with
+    :param width: Frame width, frames are downscaled to it before encoding
+    :param height: Frame height
+    :param bit_rate: Target bit rate in bits per second
+    """
+    name    : str = 'full'
+    width   : int = 640
+    height  : int = 480
+    bit_rate: int = 2000000
+
+def h264_nvenc(rendition: Rendition | None = None):
+    rendition = rendition or Rendition()
     hwaccel = HWAccel(device_type='cuda', allow_software_fallback=False)
     encoder = av.CodecContext.create('h264_nvenc', 'w', hwaccel)
-    encoder.width = 640
-    encoder.height = 480
+    encoder.width = rendition.width
+    encoder.height = rendition.height
     encoder.pix_fmt = 'yuv420p'
-    encoder.bit_rate = 2000000  
+    encoder.bit_rate = rendition.bit_rate
     encoder.framerate = 30 
     encoder.profile =  'main'
     encoder.options = {
@@ -41,22 +58,82 @@ def h264_nvenc():
         'temporal_aq': '0',        # enable temporal AQ. Benefical for non moving background area
         'device': '0',             # gpu device index
         'bf': '0',                 # Disable B-frames for lower latency. higher value = lower size 
-        'g': '240'             # gop
+        'g': '240',            # gop
+        'forced-idr': '1',         # Frames forced to I (keyframe requests of joining viewers) become IDR frames
     }
     Log.info(f"Using HwAccel cuda and encoders h264_nvenc. HwAccel is supported: {encoder.is_hwaccel}")
     return encoder
 
-def libx264_encoder():
+@dataclass
+class EncoderConfig:
+    """
+    libx264 tuning.
+
+    :param preset: x264 preset, faster presets trade compression for encode time
+    :param tune: x264 tune, zerolatency disables lookahead and B-frames
+    :param threads: Encoder threads, 0 lets libx264 pick (1.5x the cores)
+    :param thread_type: 'slice' splits every frame across the threads, no added delay.
+                        'frame' encodes several frames at once, scales better but delays the stream by `threads` frames
+    :param slices: Slices per frame, 0 leaves it to libx264
+    """
+    preset     : str = 'veryfast'
+    tune       : str = 'zerolatency'
+    threads    : int = 0
+    thread_type: str = 'slice'
+    slices     : int = 0
+
+def libx264_encoder(config: EncoderConfig | None = None, rendition: Rendition | None = None):
+    config = config or EncoderConfig()
+    rendition = rendition or Rendition()
     encoder = av.CodecContext.create('libx264', 'w')
-    encoder.width = 640
-    encoder.height = 480
+    encoder.width = rendition.width
+    encoder.height = rendition.height
     encoder.pix_fmt = 'yuv420p'
-    encoder.bit_rate = 2000000  
+    encoder.bit_rate = rendition.bit_rate
     encoder.framerate = 30 
-    encoder.options = {'tune': 'zerolatency'} 
-    Log.info(f"Using libxh264_encoder")
+    encoder.thread_count = config.threads
+    encoder.thread_type = 'FRAME' if config.thread_type == 'frame' else 'SLICE'
+    # forced-idr: frames forced to I (keyframe requests of joining viewers) become IDR frames
+    encoder.options = {'preset': config.preset, 'tune': config.tune, 'forced-idr': '1'}
+    if config.slices > 0:
+        encoder.options['slices'] = str(config.slices)
+    Log.info(f"Using libxh264_encoder ({rendition.name} {rendition.width}x{rendition.height}), preset {config.preset}, {config.threads or 'auto'} {config.thread_type} threads")
     return encoder
 
+def get_encoder(codec_name: str, device_type: str | HWDeviceType | None = None, config: EncoderConfig | None = None,
+                rendition: Rendition | None = None):
+    """
+    h264_nvenc when the codec exists and supports `device_type`, libx264 otherwise.
+
+    :param config: libx264 tuning, unused by h264_nvenc
+    :param rendition: Size and bit rate of the stream, the default is 640x480 at 2 Mbps
+    """
+    isHwSupported = False
+    isEncoderExist = False
+    try:
+        codec = av.Codec(codec_name, 'w')  
+        isEncoderExist = True
+
+        configs = codec.hardware_configs
+        if device_type is not None:
+            if not configs:
+                raise ValueError(f"{codec_name} doesn't support {device_type}")
+            
+            if isinstance(device_type, HWDeviceType):
+                device_type = device_type.name
+
+            for hw_config in configs:
+                if hw_config.device_type.name == device_type and hw_config.is_supported:
+                    isHwSupported = True
+                    break
+        
+    except Exception as e:
+        Log.exception(e, exc_info=False)
+
+    if isHwSupported or (isEncoderExist and codec_name == 'h264_nvenc'):
+        return h264_nvenc(rendition)
+    return libx264_encoder(config, rendition)
+
 def get_decoder(decoder_name: str, device_type: str | None):
     try:
         hwaccel = None
@@ -73,6 +150,19 @@ def get_decoder(decoder_name: str, device_type: str | None):
         decoder = av.CodecContext.create('h264', 'r')
         return decoder
 
+def yuv_to_shm(input_queue: ShmQueue, yuv_frame: np.ndarray, frame_id: int):
+    """
+    Convert a decoded I420 frame to BGR straight into a reserved ShmQueue slot,
+    instead of converting into a temporary and copying it in with put().
+    """
+    with input_queue.reserve(frame_id) as slot:
+        if slot is None:
+            return  # Dropped by the queue overflow policy
+        bgr_frame = cv2.cvtColor(yuv_frame, cv2.COLOR_YUV2BGR_I420, dst=slot)
+        # cvtColor allocates a new array if the decoded size doesn't match the slot
+        if bgr_frame is not slot:
+            np.copyto(slot, bgr_frame)
+
 def is_keyframe(data: bytes) -> bool:
     i = 0
     while i < len(data) - 4:
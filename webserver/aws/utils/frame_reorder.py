@@ -0,0 +1,84 @@
+import time
+from typing import Any
+
+class FrameReorderBuffer:
+    """
+    Put results coming back from several inference workers back into frame_id order.
+
+    A missing frame_id is waited for until either `window` newer frames are pending or the
+    oldest pending frame has waited `max_delay` seconds. After that the gap is skipped, and a
+    frame arriving after its slot was skipped is dropped instead of being emitted out of order.
+
+    :param window: Max number of frames held back while waiting for a gap
+    :param max_delay: Max seconds a frame is held back while waiting for a gap
+    """
+    def __init__(self, window=8, max_delay=0.1):
+        self.window = window
+        self.max_delay = max_delay
+        self.pending: dict[int, tuple[float, Any]] = {}
+        self.next_id: int | None = None
+        self.skipped = 0
+        self.late = 0
+
+    def reset(self):
+        self.pending.clear()
+        self.next_id = None
+
+    def push(self, frame_id: int, item: Any) -> list[Any]:
+        """
+        Add a result and return every item that is now ready, in frame_id order.
+        """
+        if self.next_id is None:
+            # Workers may finish the very first frames out of order too, so the stream
+            # only starts once the reorder window or delay is reached (see expire)
+            self.pending[frame_id] = (time.monotonic(), item)
+            return self.expire()
+
+        if frame_id < self.next_id:
+            if self.next_id - frame_id <= self.window * 4:
+                self.late += 1
+                return []
+            # frame_id jumped far back: the sender restarted its counter
+            ready = self.flush()
+            self.next_id = frame_id
+        else:
+            ready = []
+
+        self.pending[frame_id] = (time.monotonic(), item)
+        ready.extend(self._drain())
+        ready.extend(self.expire())
+        return ready
+
+    def expire(self) -> list[Any]:
+        """
+        Skip gaps that have been waited on for too long, return the items released by it.
+        """
+        ready = []
+        now = time.monotonic()
+        while self.pending:
+            oldest_id = min(self.pending)
+            arrived, _ = self.pending[oldest_id]
+            if len(self.pending) <= self.window and now - arrived < self.max_delay:
+                break
+            if self.next_id is not None:
+                self.skipped += oldest_id - self.next_id
+            self.next_id = oldest_id
+            ready.extend(self._drain())
+        return ready
+
+    def flush(self) -> list[Any]:
+        """
+        Release everything pending, in frame_id order.
+        """
+        ready = [self.pending[frame_id][1] for frame_id in sorted(self.pending)]
+        if self.pending:
+            self.next_id = max(self.pending) + 1
+        self.pending.clear()
+        return ready
+
+    def _drain(self) -> list[Any]:
+        ready = []
+        while self.next_id in self.pending:
+            ready.append(self.pending.pop(self.next_id)[1])
+            self.next_id += 1
+        return ready
@@ -0,0 +1,60 @@
+import json
+import time
+from utils.logger import Log
+
+class LatencyReport:
+    """
+    Per frame latency a WebSocket viewer reports back over its socket, logged as a summary every `interval` seconds.
+
+    A report is `{"type": "latency", "frame_id": ..., "sent": ..., "decode_ms": ...}`: `sent` echoes the send
+    time of the batched message the frame arrived in (see batch_message) and `decode_ms` is the time the client
+    spent between receiving and drawing it. The round trip is measured on the server clock, from sending the
+    message to receiving the report, so it holds transfer, decode and the way back.
+
+    :param name: Viewer name used in the log
+    :param interval: Seconds between two summaries
+    """
+    def __init__(self, name: str, interval=5.0):
+        self.name = name
+        self.interval = interval
+        self.since = time.monotonic()
+        self.round_trips: list[float] = []
+        self.decodes: list[float] = []
+        self.last_frame_id: int | None = None
+
+    def add_message(self, text: str):
+        """Record a text message of the client, anything but a latency report is ignored."""
+        try:
+            report = json.loads(text)
+        except ValueError:
+            return
+        if not isinstance(report, dict) or report.get("type") != "latency":
+            return
+
+        try:
+            round_trip = time.time() - float(report["sent"])
+            decode = float(report.get("decode_ms", 0.0)) / 1000
+        except (KeyError, TypeError, ValueError):
+            return
+
+        self.round_trips.append(round_trip)
+        self.decodes.append(decode)
+        self.last_frame_id = report.get("frame_id")
+
+        now = time.monotonic()
+        if now - self.since >= self.interval:
+            Log.info(f"{self.name} latency: {self.summary()}")
+            self.round_trips.clear()
+            self.decodes.clear()
+            self.since = now
+
+    def summary(self) -> dict:
+        if not self.round_trips:
+            return {"frames": 0}
+        return {
+            "frames": len(self.round_trips),
+            "frame_id": self.last_frame_id,
+            "round_trip_ms": round(1000 * sum(self.round_trips) / len(self.round_trips), 1),
+            "round_trip_max_ms": round(1000 * max(self.round_trips), 1),
+            "decode_ms": round(1000 * sum(self.decodes) / len(self.decodes), 1),
+        }
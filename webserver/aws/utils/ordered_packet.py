@@ -1,22 +1,81 @@
 import asyncio
-import heapq
 import time
+from collections import deque
+from typing import Callable
 from utils.logger import Log
-from constants import frame_dispatch_reset, INFERENCE_ENABLED, INCOMING_FORMAT, OUTGOING_FORMAT, Format
+from utils.wire import WirePayload
+from utils.packet_queue import KeyframeDropQueue, is_keyframe_packet
+from utils.broadcast import BroadcastHub
+from constants import frame_dispatch_reset, INFERENCE_ENABLED, INCOMING_FORMAT, OUTGOING_FORMAT, Format, STREAM_FPS, REORDER_TIMEOUT, REORDER_TIMEOUT_MIN, REORDER_TIMEOUT_MAX, REORDER_PERCENTILE, REORDER_JITTER_FACTOR
 
 class OrderedPacketDispatcher:
-    def __init__(self, input: asyncio.Queue, output: asyncio.Queue | list[asyncio.Queue], max_fps=30, timeout=0.4, poll_interval=0.03):
+    """
+    Put the frames of the UDP protocols back into frame_id order before they reach the decoder / viewers.
+
+    Frames are kept in a fixed reorder window, slot `frame_id % window`. The dispatcher sleeps on the input
+    queue and releases every in-order frame as soon as it arrives, so in-order traffic isn't delayed at all.
+    A missing frame_id opens a gap with its own deadline, `timeout` seconds after the first frame behind it
+    arrived. The gap is skipped once the deadline passes, or right away when a frame no longer fits the window.
+
+    The timeout adapts to the link, like an RTP jitter buffer. It is the `percentile` of the time gaps took
+    to fill (reordered or retransmitted frames, frames that came after their gap was skipped included), and
+    at least `jitter_factor` times the inter-arrival jitter (RFC 3550 estimator), within [min_timeout, max_timeout].
+
+    H.264 frames depend on the ones before them, so once a frame is lost everything is dropped up to the next
+    keyframe (frame_type byte of the `>QB` header) instead of feeding the decoder and inference garbage, and the
+    sender is asked for one through `keyframe_requester`. The stream also starts on a keyframe.
+
+    :param input: (frame_id, packet_data) items of the protocol
+    :param output: Decoder / encoder queue, or the viewer hub when the packets go out untouched
+    :param timeout: Seconds a gap is waited for until enough arrivals were measured
+    :param window: Max frames held back behind a gap
+    :param passthrough: Viewers that also get the ordered packets untouched (inference metadata mode)
+    :param keyframe_requester: Asks the sender for a keyframe, called again every `keyframe_interval` seconds until one arrives
+    """
+    def __init__(self, input: asyncio.Queue, output: asyncio.Queue | BroadcastHub, timeout=REORDER_TIMEOUT, window=64,
+                 passthrough: BroadcastHub | None = None, min_timeout=REORDER_TIMEOUT_MIN, max_timeout=REORDER_TIMEOUT_MAX,
+                 percentile=REORDER_PERCENTILE, jitter_factor=REORDER_JITTER_FACTOR,
+                 keyframe_requester: Callable[[], None] | None = None, keyframe_interval=0.5):
         assert isinstance(input, asyncio.Queue), "input_queue must be a ShmQueue instance."
         
         self.input = input
-        self.max_fps = max_fps
+        # Viewers that also get the ordered packets untouched (inference metadata mode)
+        self.passthrough = passthrough
         self.timeout = timeout
-        self.poll_interval = poll_interval
+        self.window = window
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.percentile = percentile
+        self.jitter_factor = jitter_factor
+        self.frame_interval = 1 / STREAM_FPS
+        self.idle_interval = 0.5    # Wake up this often without traffic to notice frame_dispatch_reset
+        self.adapt_after = 30       # Arrivals measured before the timeout adapts
+        self.report_interval = 10.0
+        self.h264 = INCOMING_FORMAT.value == Format.H264.value
+        self.keyframe_requester = keyframe_requester
+        self.keyframe_interval = keyframe_interval
 
-        self.buffer = []
-        self.received_map = {}
-        self.expected_frame_id = None
-        self.last_dispatch_time = 0.0
+        self.slots: list[tuple[int, bytes, float] | None] = [None] * window
+        self.pending = 0
+        self.expected_frame_id: int | None = None
+        self.gap_opened = 0.0
+        self.gap_deadline: float | None = None
+        self.skipped_gaps: dict[int, float] = {}  # Recently skipped frame_id -> when its gap opened
+
+        self.arrivals = 0
+        self.last_arrival: tuple[int, float] | None = None
+        self.jitter = 0.0
+        self.recoveries: deque[float] = deque(maxlen=256)
+        self.recovery_time = 0.0    # `percentile` of recoveries
+        self.recovered = 0
+        self.late = 0
+        self.dropped = 0
+        self.reported = time.monotonic()
+
+        self.waiting_keyframe = self.h264
+        self.keyframe_requested = 0.0
+        self.keyframe_requests = 0
+        self.discarded = 0      # Frames received fine but dropped waiting for a keyframe
 
         if INFERENCE_ENABLED:
             assert isinstance(output, asyncio.Queue), \
@@ -24,9 +83,10 @@ class OrderedPacketDispatcher:
             self.output = output
         else:
             if INCOMING_FORMAT.value == Format.H264.value and OUTGOING_FORMAT.value == Format.H264.value:
-                assert isinstance(output, list) and all(isinstance(q, asyncio.Queue) for q in output), \
-                    "When inference is disabled and (H264 TO H264), input_queue must be a list of asyncio.Queue instances."
-                self.frame_queue = output
+                assert isinstance(output, BroadcastHub), \
+                    "When inference is disabled and (H264 TO H264), output must be a BroadcastHub instance."
+                self.frame_hub = output
+                self.output = output
             elif INCOMING_FORMAT.value == Format.H264.value and OUTGOING_FORMAT.value == Format.JPG.value:
                 assert isinstance(output, asyncio.Queue), "When inference is disabled and output (H264 TO JPG), input_queue must be a asyncio.Queue instances."
                 self.output = output
@@ -38,108 +98,205 @@ class OrderedPacketDispatcher:
 
     def __reset(self):
         """Reset internal state to initial values."""
-        self.buffer.clear()  # Clear the buffer (list)
-        self.received_map.clear()  # Clear the received map (dictionary)
-        self.expected_frame_id = None  # Reset expected frame ID
-        self.last_dispatch_time = 0.0  # Reset last dispatch time
+        self.slots = [None] * self.window
+        self.pending = 0
+        self.expected_frame_id = None
+        self.gap_deadline = None
+        self.skipped_gaps.clear()
+        self.last_arrival = None
+        self.waiting_keyframe = self.h264
         Log.info("OrderedPacketDispatcher state has been reset.")
 
     async def run(self):
-        first_frame_set = False
-
         while True:
             try:
-                # Drain available inputs
-                try:
-                    if frame_dispatch_reset['value']:
-                        self.__reset()
-                        first_frame_set = False
-                        frame_dispatch_reset['value'] = False
-                        continue
+                if frame_dispatch_reset['value']:
+                    self.__reset()
+                    frame_dispatch_reset['value'] = False
 
-                    while True:
-                        if not self.input.empty():
-                            frame_id, packet_data = self.input.get_nowait()
-                            if frame_id not in self.received_map:
-                                self.received_map[frame_id] = packet_data
-                                heapq.heappush(self.buffer, (frame_id, packet_data))
-                            await asyncio.sleep(0)
-                        else:
-                            break
-                except asyncio.QueueEmpty:
-                    pass
-
-                # Initialize expected frame ID
-                if not first_frame_set and self.buffer:
-                    self.expected_frame_id = self.buffer[0][0]
-                    first_frame_set = True
-
-                # Drop outdated frames
-                while self.buffer and self.buffer[0][0] < self.expected_frame_id:
-                    outdated_id, _ = heapq.heappop(self.buffer)
-                    self.received_map.pop(outdated_id, None)
-
-                # Wait up to `timeout` for expected frame to arrive . waited = self.timeout + self.poll interval
-                waited = 0.0
-                found = False
-                while waited < self.timeout:
-                    if self.buffer and self.buffer[0][0] == self.expected_frame_id:
-                        found = True
-                        break
-
-                    await asyncio.sleep(self.poll_interval)
-                    waited += self.poll_interval
-
-                    # Try to collect more frames
+                if self.input.empty():
+                    if self.gap_deadline is None:
+                        wait = self.idle_interval
+                    else:
+                        wait = max(0.0, self.gap_deadline - time.monotonic())
                     try:
-                        while True:
-                            if not self.input.empty():
-                                frame_id, packet_data = self.input.get_nowait()
-                                if frame_id not in self.received_map:
-                                    self.received_map[frame_id] = packet_data
-                                    heapq.heappush(self.buffer, (frame_id, packet_data))
-                                await asyncio.sleep(0)
-                            else:
-                                break
-                    except asyncio.QueueEmpty:
-                        pass
-
-                if found:
-                    while self.buffer and self.buffer[0][0] == self.expected_frame_id:
-                        frame_id, packet_data = heapq.heappop(self.buffer)
-                        self.received_map.pop(frame_id, None)
-
-                        if INFERENCE_ENABLED or OUTGOING_FORMAT.value == Format.JPG.value or INCOMING_FORMAT.value == Format.JPG.value:
-                            if not self.output.full():
-                                self.output.put_nowait((packet_data, frame_id))
-                        else:
-                            timestamped_frame = (time.time(), packet_data)
-                            for q in self.frame_queue:
-                                if not q.full():
-                                    q.put_nowait(timestamped_frame)
-
-                        if self.expected_frame_id is not None:
-                            self.expected_frame_id += 1
-                    # Throttle output to max FPS . (disable for now)
-                    '''                    
-                    now = time.monotonic()
-                    elapsed = now - self.last_dispatch_time
-                    wait_time = max(0, (1 / self.max_fps) - elapsed)
-                    if wait_time > 0:
-                        await asyncio.sleep(wait_time)
-                    self.last_dispatch_time = time.monotonic()
-                    '''
-
+                        item = await asyncio.wait_for(self.input.get(), wait)
+                    except asyncio.TimeoutError:
+                        if self.gap_deadline is not None and time.monotonic() >= self.gap_deadline:
+                            self.__skip_gap()
+                        continue
                 else:
-                    Log.warning(f"[Dispatcher] Timeout {waited} waiting for frame_id {self.expected_frame_id}, skipping.")
+                    item = self.input.get_nowait()
 
-                    if self.expected_frame_id is not None:
-                        if self.buffer:
-                            self.expected_frame_id = self.buffer[0][0]
-
-                await asyncio.sleep(0.002)
+                self.__insert(*item)
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 Log.exception(f"[Dispatcher] Error: {e}")
 
+    def __insert(self, frame_id: int, packet_data: bytes):
+        now = time.monotonic()
+
+        if self.expected_frame_id is None:
+            self.expected_frame_id = frame_id
+
+        if frame_id < self.expected_frame_id:
+            if self.expected_frame_id - frame_id <= self.window * 4:
+                # Its gap was skipped already, the timeout was too short for it
+                self.__measure_arrival(frame_id, now)
+                self.late += 1
+                opened = self.skipped_gaps.pop(frame_id, None)
+                if opened is not None:
+                    self.__add_recovery(now - opened)
+                return
+            # frame_id jumped far back: the sender restarted its counter
+            self.__flush()
+            self.expected_frame_id = frame_id
+            self.last_arrival = None
+
+        self.__measure_arrival(frame_id, now)
+
+        # No room behind the gap, skip it right away
+        while frame_id >= self.expected_frame_id + self.window:
+            if self.pending:
+                self.__skip_gap()
+            else:
+                self.__skip_to(frame_id, now)
+
+        index = frame_id % self.window
+        if self.slots[index] is not None:
+            return  # Duplicate
+        self.slots[index] = (frame_id, packet_data, now)
+        self.pending += 1
+
+        if self.gap_deadline is not None and frame_id == self.expected_frame_id:
+            self.recovered += 1
+            self.__add_recovery(now - self.gap_opened)
+
+        self.__drain()
+
+        if now - self.reported >= self.report_interval:
+            self.reported = now
+            if self.late or self.dropped or self.discarded:
+                Log.info(f"[Dispatcher] {self.metrics()}")
+
+    def __measure_arrival(self, frame_id: int, now: float):
+        # RFC 3550 interarrival jitter, frame_id standing in for the RTP timestamp. A jump further than
+        # the window (restart, 24-bit wrap) is no jitter, the next sample is taken from this frame on
+        if self.last_arrival is not None and abs(frame_id - self.last_arrival[0]) <= self.window:
+            last_id, last_time = self.last_arrival
+            difference = (now - last_time) - (frame_id - last_id) * self.frame_interval
+            self.jitter += (abs(difference) - self.jitter) / 16
+        self.last_arrival = (frame_id, now)
+        self.arrivals += 1
+        self.__adapt()
+
+    def __add_recovery(self, waited: float):
+        self.recoveries.append(waited)
+        samples = sorted(self.recoveries)
+        self.recovery_time = samples[min(len(samples) - 1, len(samples) * self.percentile // 100)]
+        self.__adapt()
+
+    def __adapt(self):
+        if self.arrivals < self.adapt_after:
+            return
+        timeout = max(self.recovery_time, self.jitter_factor * self.jitter)
+        self.timeout = min(max(timeout, self.min_timeout), self.max_timeout)
+
+    def __drain(self):
+        # Release every frame in order, then arm the deadline of the gap left, if any
+        while self.pending:
+            index = self.expected_frame_id % self.window
+            slot = self.slots[index]
+            if slot is None:
+                break
+            self.slots[index] = None
+            self.pending -= 1
+            self.expected_frame_id += 1
+            self.__dispatch(slot[0], slot[1])
+
+        if not self.pending:
+            self.gap_deadline = None
+        elif self.gap_deadline is None:
+            self.gap_opened = self.__next_slot()[2]
+            self.gap_deadline = self.gap_opened + self.timeout
+
+    def __next_slot(self) -> tuple[int, bytes, float]:
+        for offset in range(1, self.window):
+            slot = self.slots[(self.expected_frame_id + offset) % self.window]
+            if slot is not None:
+                return slot
+
+    def __skip_gap(self):
+        if not self.pending:
+            return
+        frame_id = self.__next_slot()[0]
+        Log.warning(f"[Dispatcher] Timeout waiting for frame_id {self.expected_frame_id}, skipping to {frame_id}.")
+        self.__skip_to(frame_id, self.gap_opened)
+        self.gap_deadline = None
+        self.__drain()
+
+    def __skip_to(self, frame_id: int, opened: float):
+        # Remember when the skipped frames were first missed, in case they still arrive
+        for skipped_id in range(max(self.expected_frame_id, frame_id - self.window), frame_id):
+            self.skipped_gaps[skipped_id] = opened
+        while len(self.skipped_gaps) > self.window * 4:
+            del self.skipped_gaps[next(iter(self.skipped_gaps))]
+
+        self.dropped += frame_id - self.expected_frame_id
+        self.expected_frame_id = frame_id
+        if self.h264 and not self.waiting_keyframe:
+            # Frames after the loss reference what was lost
+            self.waiting_keyframe = True
+            self.__request_keyframe()
+
+    def __request_keyframe(self):
+        if self.keyframe_requester is None:
+            return
+        now = time.monotonic()
+        if now - self.keyframe_requested >= self.keyframe_interval:
+            self.keyframe_requested = now
+            self.keyframe_requests += 1
+            self.keyframe_requester()
+
+    def __flush(self):
+        while self.pending:
+            self.__skip_gap()
+
+    def __dispatch(self, frame_id: int, packet_data: bytes):
+        if self.waiting_keyframe:
+            if not is_keyframe_packet(packet_data):
+                self.discarded += 1
+                self.__request_keyframe()
+                return
+            self.waiting_keyframe = False
+
+        if self.passthrough is not None:
+            timestamped_frame = (time.time(), WirePayload(packet_data, frame_id))
+            self.passthrough.publish(timestamped_frame, is_keyframe_packet(packet_data))
+
+        if isinstance(self.output, KeyframeDropQueue):
+            # Decoder branch, drops on its own without holding back the viewers above
+            self.output.offer((packet_data, frame_id))
+        elif INFERENCE_ENABLED or OUTGOING_FORMAT.value == Format.JPG.value or INCOMING_FORMAT.value == Format.JPG.value:
+            if not self.output.full():
+                self.output.put_nowait((packet_data, frame_id))
+        else:
+            timestamped_frame = (time.time(), WirePayload(packet_data, frame_id))
+            self.frame_hub.publish(timestamped_frame, is_keyframe_packet(packet_data))
+
+    def metrics(self) -> dict:
+        """
+        Current gap wait and the counters. dropped counts late frames too, discarded the frames dropped
+        waiting for a keyframe.
+        """
+        return {
+            "timeout": round(self.timeout, 4),
+            "jitter": round(self.jitter, 4),
+            "recovery_time": round(self.recovery_time, 4),
+            "recovered": self.recovered,
+            "late": self.late,
+            "dropped": self.dropped,
+            "discarded": self.discarded,
+            "keyframe_requests": self.keyframe_requests,
+        }
@@ -0,0 +1,95 @@
+import asyncio
+
+def is_keyframe_packet(packet_data: bytes) -> bool:
+    """frame_type byte of the `>QB` (timestamp_us, frame_type) header in front of every H.264 packet."""
+    return len(packet_data) > 8 and packet_data[8] == 1
+
+START_CODE = b'\x00\x00\x01'
+NAL_IDR, NAL_SPS, NAL_PPS = 5, 7, 8
+
+def nal_units(packet_data: bytes, offset=9):
+    """
+    Yield (nal_type, start, end) for the Annex B NAL units of a `>QB` framed packet.
+    start / end delimit the unit including its start code.
+    """
+    position = packet_data.find(START_CODE, offset)
+    while position != -1 and position + 3 < len(packet_data):
+        start = position - 1 if position > offset and packet_data[position - 1] == 0 else position
+        next_position = packet_data.find(START_CODE, position + 3)
+        end = len(packet_data) if next_position == -1 else next_position
+        # Leading zero of a 4 byte start code belongs to the next unit
+        if next_position != -1 and packet_data[next_position - 1] == 0:
+            end -= 1
+        yield packet_data[position + 3] & 0x1F, start, end
+        position = next_position
+
+class ParameterSetCache:
+    """
+    Latest SPS / PPS of an H.264 stream. Encoders may send them only once, ahead of the first IDR,
+    a viewer joining on a later keyframe needs them put back in front of it.
+    """
+    def __init__(self):
+        self.sps: bytes | None = None
+        self.pps: bytes | None = None
+
+    def complete(self, packet_data: bytes) -> bytes:
+        """
+        Remember the parameter sets of a keyframe packet.
+
+        :return: The packet, with the cached SPS / PPS inserted ahead of its IDR slice if it carries none
+        """
+        found = set()
+        idr = None
+        for nal_type, start, end in nal_units(packet_data):
+            if nal_type == NAL_SPS:
+                self.sps = packet_data[start:end]
+            elif nal_type == NAL_PPS:
+                self.pps = packet_data[start:end]
+            elif nal_type == NAL_IDR:
+                # Parameter sets precede the slices, no need to scan the slice data
+                idr = start
+                break
+            found.add(nal_type)
+
+        if idr is None or (NAL_SPS in found and NAL_PPS in found) or self.sps is None or self.pps is None:
+            return packet_data
+        return packet_data[:idr] + self.sps + self.pps + packet_data[idr:]
+
+class KeyframeDropQueue(asyncio.Queue):
+    """
+    Bounded H.264 packet queue for a decoder that is allowed to fall behind without slowing its producer.
+
+    Dropping a single delta frame would break the reference chain of every frame after it, so once the
+    queue is full everything is dropped until the next keyframe. A keyframe arriving on a full queue
+    replaces the stale backlog, letting the decoder resume on the newest picture.
+
+    :param maxsize: Max number of packets waiting for the decoder
+    """
+    def __init__(self, maxsize=30):
+        super().__init__(maxsize)
+        self.dropping = False
+        self.dropped = 0
+
+    def offer(self, item: tuple[bytes, int]) -> bool:
+        """
+        Queue a (packet_data, frame_id) item without ever blocking.
+
+        :return: False when the packet was dropped
+        """
+        keyframe = is_keyframe_packet(item[0])
+
+        if keyframe and self.full():
+            while not self.empty():
+                self.get_nowait()
+                self.dropped += 1
+        elif self.dropping and not keyframe:
+            self.dropped += 1
+            return False
+        elif self.full():
+            self.dropping = True
+            self.dropped += 1
+            return False
+
+        self.dropping = False
+        self.put_nowait(item)
+        return True
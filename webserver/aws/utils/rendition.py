@@ -0,0 +1,116 @@
+import time
+from typing import Any
+from constants import frame_hub, rendition_hubs, RENDITION_DOWNGRADE_AGE, RENDITION_UPGRADE_AFTER
+from utils.logger import Log
+from utils.broadcast import BroadcastHub, Subscription
+
+AUTO = 'auto'
+
+class RenditionSubscriber:
+    """
+    Viewer subscribed to one rendition of the simulcast ladder (see rendition_hubs).
+
+    An explicit rendition sticks. With 'auto' the viewer starts on the heaviest rendition, moves one step
+    lighter whenever it receives frames older than RENDITION_DOWNGRADE_AGE or had to skip frames, and one
+    step heavier after RENDITION_UPGRADE_AFTER seconds without lag. The GOP a hub replays on joining doesn't
+    count, those frames are old by design.
+
+    A switch only takes effect on a keyframe of the new rendition, either the GOP its hub replays to a new
+    subscriber or the next one published: until then the viewer keeps receiving the old rendition, so its
+    decoder never sees a delta frame it has no reference for.
+
+    Without simulcast the subscriber reads frame_hub.
+
+    :param rendition: Rendition name or 'auto'. Unknown names fall back to 'auto'
+    """
+    viewers: set['RenditionSubscriber'] = set()
+    """Subscribers not closed yet, their metrics() are served on /viewer_status"""
+
+    def __init__(self, rendition: str | None = AUTO):
+        self.names = list(rendition_hubs)
+        self.auto = rendition not in self.names
+        self.current = rendition if not self.auto else (self.names[0] if self.names else None)
+
+        self.subscription: Subscription = self.hub(self.current).subscribe()
+        self.pending: Subscription | None = None
+        self.pending_name: str | None = None
+        self.calm_since = time.monotonic()
+        self.skips = 0
+        self.switches = 0
+        RenditionSubscriber.viewers.add(self)
+
+    def hub(self, name: str | None) -> BroadcastHub:
+        return rendition_hubs[name] if name is not None else frame_hub
+
+    async def get(self) -> tuple[float, Any]:
+        """
+        Next (timestamp, payload) of the subscribed rendition.
+        """
+        self.__check_pending()
+        return self.__delivered(await self.subscription.get())
+
+    def get_nowait(self) -> tuple[float, Any] | None:
+        """
+        Like get(), None when no item is ready yet.
+        """
+        self.__check_pending()
+        item = self.subscription.get_nowait()
+        return self.__delivered(item) if item is not None else None
+
+    def __check_pending(self):
+        if self.pending is not None and (self.pending.backlog or self.pending.hub.last_keyframe >= self.pending.cursor):
+            self.__take_over()
+
+    def __delivered(self, item: tuple[float, Any]) -> tuple[float, Any]:
+        # A replayed GOP is old by design, its age says nothing about the viewer
+        if self.auto and self.current is not None and not self.subscription.replayed:
+            self.__adapt(time.time() - item[0])
+        return item
+
+    def __take_over(self):
+        # Keyframe of the new rendition published, drop the old one from here on
+        self.subscription.close()
+        self.subscription, self.current = self.pending, self.pending_name
+        self.pending = self.pending_name = None
+        self.skips = self.subscription.skips
+        self.calm_since = time.monotonic()
+        self.switches += 1
+        Log.info(f"viewer switched to rendition {self.current}")
+
+    def __adapt(self, age: float):
+        now = time.monotonic()
+        index = self.names.index(self.current)
+        skipped = self.subscription.skips > self.skips
+        self.skips = self.subscription.skips
+
+        if age > RENDITION_DOWNGRADE_AGE or skipped:
+            self.calm_since = now
+            if self.pending is None and index + 1 < len(self.names):
+                self.switch(self.names[index + 1])
+        elif now - self.calm_since >= RENDITION_UPGRADE_AFTER:
+            self.calm_since = now
+            if self.pending is None and index > 0:
+                self.switch(self.names[index - 1])
+
+    def switch(self, name: str):
+        """
+        Start moving to another rendition, it takes over on its next keyframe.
+        """
+        if name == self.current or name not in rendition_hubs:
+            return
+
+        if self.pending is not None:
+            self.pending.close()
+
+        self.pending = self.hub(name).subscribe()
+        self.pending_name = name
+
+    def metrics(self) -> dict:
+        return {"rendition": self.current, "switches": self.switches, **self.subscription.metrics()}
+
+    def close(self):
+        RenditionSubscriber.viewers.discard(self)
+        self.subscription.close()
+        if self.pending is not None:
+            self.pending.close()
+            self.pending = None
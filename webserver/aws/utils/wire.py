@@ -0,0 +1,59 @@
+import base64
+import struct
+import time
+
+BATCH_HEADER = struct.Struct('>dH')  # server send time (seconds since epoch), number of records
+BATCH_RECORD = struct.Struct('>qI')  # frame_id (-1 when unknown), packet length, then the `>QB` framed packet
+
+class WirePayload:
+    """
+    A frame fanned out to every viewer. Each transport's wire format is built once, by the first viewer
+    that needs it, and every other viewer sends the same bytes object.
+
+    :param data: JPEG image or `>QB` framed H.264 packet, sent as is over WebSocket
+    :param frame_id: Pipeline frame_id of the packet, when the publisher knows it
+    """
+    __slots__ = ('data', 'frame_id', '_multipart', '_sse', '_record')
+
+    def __init__(self, data: bytes, frame_id: int | None = None):
+        self.data = data
+        self.frame_id = frame_id
+        self._multipart: bytes | None = None
+        self._sse: bytes | None = None
+        self._record: bytes | None = None
+
+    @property
+    def multipart(self) -> bytes:
+        """Part of the multipart/x-mixed-replace MJPEG stream."""
+        if self._multipart is None:
+            self._multipart = b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + self.data + b"\r\n\r\n"
+        return self._multipart
+
+    @property
+    def sse(self) -> bytes:
+        """Server-sent event carrying the base64 packet as `{"message": ...}`."""
+        if self._sse is None:
+            self._sse = b'data: {"message": "' + base64.b64encode(self.data) + b'"}\n\n'
+        return self._sse
+
+    @property
+    def record(self) -> bytes:
+        """Record of a batched WebSocket message, see batch_message."""
+        if self._record is None:
+            frame_id = self.frame_id if self.frame_id is not None else -1
+            self._record = BATCH_RECORD.pack(frame_id, len(self.data)) + self.data
+        return self._record
+
+def batch_message(payloads: list[WirePayload]) -> bytes:
+    """
+    Binary WebSocket message carrying one or more H.264 packets.
+
+        | send time | count | frame_id | length | packet | frame_id | length | packet | ...
+
+    The send time is stamped per message, clients echo it back with their latency reports.
+    """
+    return BATCH_HEADER.pack(time.time(), len(payloads)) + b"".join(payload.record for payload in payloads)
+
+def text_event(text: str, event: str) -> bytes:
+    """Named server-sent event for a single line text payload (JSON without newlines)."""
+    return f"event: {event}\ndata: {text}\n\n".encode()
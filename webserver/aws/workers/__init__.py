@@ -0,0 +1,4 @@
+from .decoder import DecodeWorker, forward_packets
+from .encoder import EncodeWorker, publish_packets
+
+__all__ = ['DecodeWorker', 'forward_packets', 'EncodeWorker', 'publish_packets']
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import struct
+from fractions import Fraction
+from inference import ShmQueue, ShmByteRing, QueueStoppedError
+from consumers.detections import DetectionConsumer
+from constants import FFMPEG_DIR
+from utils.logger import Log
+from utils.packet_queue import is_keyframe_packet
+from utils.ffmpeg_helper import get_decoder, yuv_to_shm
+
+# Import ffmpeg
+if os.path.exists(FFMPEG_DIR):
+    os.add_dll_directory(FFMPEG_DIR)
+from av.packet import Packet
+
+class DecodeWorker:
+    """
+    Decode H.264 packets in a dedicated process and write the frames straight into the inference input queue,
+    so neither the codec nor the colour conversion ever runs on the event loop serving the viewers.
+
+    :param packet_ring: Ring the event loop writes the `>QB` framed packets into, see forward_packets
+    :param input_queue: Inference input queue decoded frames are converted into
+    :param decoder_name: Decoder codec name
+    :param device_type: Hardware device type of the decoder, None decodes in software
+    """
+    def __init__(self, packet_ring: ShmByteRing, input_queue: ShmQueue, decoder_name: str, device_type: str | None = None):
+        self.packet_ring = packet_ring
+        self.input_queue = input_queue
+        self.decoder_name = decoder_name
+        self.device_type = device_type
+
+    @staticmethod
+    def __unpack_packet(packet_data: bytes):
+        timestamp_us, frame_type = struct.unpack(">QB",  packet_data[:9])
+        return timestamp_us, frame_type, packet_data[9:]
+
+    def run(self):
+        decoder = get_decoder(self.decoder_name, self.device_type)
+        Log.info(f"using {decoder.name}")
+        time_base = (Fraction(1, 30)) * 1_000_000
+
+        while True:
+            try:
+                frame_id, encoded_packet_bytes = self.packet_ring.get()
+                timestamp_us, frame_type, packet_data = DecodeWorker.__unpack_packet(encoded_packet_bytes)
+
+                packet = Packet(packet_data)
+                packet.is_keyframe = True if frame_type == 1 else False
+                packet.pts = round(timestamp_us / time_base)
+                decoded_video_frames = decoder.decode(packet)
+
+                if len(decoded_video_frames) <= 0:
+                    continue
+
+                yuv_to_shm(self.input_queue, decoded_video_frames[0].to_ndarray(), frame_id)
+            except KeyboardInterrupt:
+                break
+            except QueueStoppedError:
+                break
+            except Exception as e:
+                Log.exception(f"error at decode worker: {e}")
+
+async def forward_packets(decode_queue: asyncio.Queue, packet_ring: ShmByteRing, detections: DetectionConsumer | None = None):
+    """
+    Move packets from the decode queue into the decode worker ring. Only a copy happens on the event loop,
+    a full ring drops up to the next keyframe.
+
+    :param detections: Metadata mode relay, gets the packet header timestamp of every forwarded frame
+    """
+    while True:
+        try:
+            encoded_packet_bytes, frame_id = await decode_queue.get()
+
+            if not packet_ring.put(frame_id, encoded_packet_bytes, is_keyframe_packet(encoded_packet_bytes)):
+                continue
+
+            # Metadata mode: viewers match detections to their packets through the header timestamp
+            if detections is not None:
+                timestamp_us, = struct.unpack_from(">Q", encoded_packet_bytes)
+                detections.remember(frame_id, timestamp_us)
+        except asyncio.CancelledError:
+            break
+        except QueueStoppedError:
+            break
+        except Exception as e:
+            Log.exception(f"error at forward_packets: {e}")
@@ -0,0 +1,173 @@
+import asyncio
+import multiprocessing.synchronize
+import os
+import queue
+import struct
+import time
+import cv2
+import numpy as np
+from inference import ShmQueue, ShmByteRing, QueueStoppedError
+from constants import FFMPEG_DIR, SHOW_FPS, INFERENCE_WORKERS, INFERENCE_REORDER_WINDOW, INFERENCE_REORDER_DELAY
+from utils.logger import Log
+from utils.wire import WirePayload
+from utils.frame_reorder import FrameReorderBuffer
+from utils.broadcast import BroadcastHub
+from utils.packet_queue import is_keyframe_packet
+from utils.ffmpeg_helper import EncoderConfig, Rendition, get_encoder
+
+# Import ffmpeg
+if os.path.exists(FFMPEG_DIR):
+    os.add_dll_directory(FFMPEG_DIR)
+import av
+from av.video.frame import PictureType
+
+class EncodeWorker:
+    """
+    Encode the inference output frames to H.264 in a dedicated process and hand the packets back
+    to the event loop through one ShmByteRing per rendition, see publish_packets.
+
+    Every frame is encoded once per rendition (simulcast). With a single inference worker frames are
+    downscaled and converted to I420 straight out of the borrowed shared memory slot into reused buffers.
+    Several workers finish frames out of order, they are copied out and put back in frame_id order first.
+
+    Setting the `keyframe_requests` Event of a rendition makes its next frame an IDR frame, so joining or lagging
+    viewers don't wait for the end of the GOP. The other renditions keep their GOP.
+
+    :param output_queue: Inference output queue
+    :param packet_rings: Rendition name -> ring the `>QB` framed packets of that rendition are written into
+    :param codec_name: Encoder codec name
+    :param device_type: Hardware device type of the encoder, None encodes in software
+    :param config: libx264 tuning, see EncoderConfig
+    :param renditions: Simulcast ladder, a single 640x480 stream by default
+    :param keyframe_requests: Rendition name -> Event the event loop sets to force a keyframe, cleared once it is encoded
+    """
+    def __init__(self, output_queue: ShmQueue, packet_rings: dict[str, ShmByteRing], codec_name: str, device_type: str | None = None,
+                 config: EncoderConfig | None = None, renditions: list[Rendition] | None = None,
+                 keyframe_requests: dict[str, multiprocessing.synchronize.Event] | None = None):
+        self.output_queue = output_queue
+        self.packet_rings = packet_rings
+        self.codec_name = codec_name
+        self.device_type = device_type
+        self.config = config
+        self.renditions = renditions or [Rendition()]
+        self.keyframe_requests = keyframe_requests or {}
+        self.resize_buffers: dict[str, np.ndarray] = {}
+        self.yuv_buffers: dict[str, np.ndarray] = {}
+
+        self.reorder = None
+        if INFERENCE_WORKERS > 1:
+            self.reorder = FrameReorderBuffer(INFERENCE_REORDER_WINDOW, INFERENCE_REORDER_DELAY)
+
+    def run(self):
+        encoders = {
+            rendition.name: get_encoder(self.codec_name, self.device_type, self.config, rendition)
+            for rendition in self.renditions
+        }
+        Log.info(f"using {next(iter(encoders.values())).name} for {len(encoders)} rendition(s)")
+
+        while True:
+            try:
+                if self.reorder is None:
+                    with self.output_queue.borrow() as (frame_bgr, frame_id):
+                        self.encode_renditions(encoders, frame_bgr, frame_id)
+                    continue
+
+                try:
+                    _out = self.output_queue.get(timeout=self.reorder.max_delay / 2)
+                    ready = self.reorder.push(_out[1], _out)
+                except queue.Empty:
+                    ready = self.reorder.expire()
+
+                for frame_bgr, frame_id in ready:
+                    self.encode_renditions(encoders, frame_bgr, frame_id)
+            except KeyboardInterrupt:
+                break
+            except QueueStoppedError:
+                break
+            except Exception as e:
+                Log.exception(f"error at encode worker: {e}")
+
+    def encode_renditions(self, encoders: dict[str, av.CodecContext], frame_bgr: np.ndarray, frame_id: int):
+        for rendition in self.renditions:
+            keyframe_request = self.keyframe_requests.get(rendition.name)
+            force_keyframe = keyframe_request is not None and keyframe_request.is_set()
+            if force_keyframe:
+                keyframe_request.clear()
+
+            frame = frame_bgr
+            if frame.shape[:2] != (rendition.height, rendition.width):
+                resize_buffer = self.buffer(self.resize_buffers, rendition.name, (rendition.height, rendition.width, 3))
+                frame = cv2.resize(frame_bgr, (rendition.width, rendition.height), dst=resize_buffer, interpolation=cv2.INTER_AREA)
+
+            self.encode(encoders[rendition.name], self.packet_rings[rendition.name], rendition.name, frame, frame_id, force_keyframe)
+
+    @staticmethod
+    def buffer(buffers: dict[str, np.ndarray], name: str, shape: tuple) -> np.ndarray:
+        """Reused per rendition buffer, reallocated only when the frame size changes."""
+        if name not in buffers or buffers[name].shape != shape:
+            buffers[name] = np.empty(shape, dtype=np.uint8)
+        return buffers[name]
+
+    def encode(self, encoder: av.CodecContext, packet_ring: ShmByteRing, name: str, frame_bgr: np.ndarray, frame_id: int,
+               force_keyframe=False):
+        height, width = frame_bgr.shape[:2]
+        yuv_buffer = self.buffer(self.yuv_buffers, name, (height * 3 // 2, width))
+
+        img_yuv = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2YUV_I420, dst=yuv_buffer)
+        # from_ndarray copies into a frame owned by the encoder, frame threads may still be reading older ones
+        video_frame = av.VideoFrame.from_ndarray(img_yuv, format='yuv420p')
+        if force_keyframe:
+            video_frame.pict_type = PictureType.I
+
+        # Frame threading can return no packet, or several, per frame
+        for encoded_packet in encoder.encode(video_frame):
+            timestamp_us = int(encoded_packet.pts * encoded_packet.time_base * 1_000_000)
+            frame_type = 1 if encoded_packet.is_keyframe else 0
+
+            # timestamp (8 byte) || frame_type (1 byte) || raw H.264  (N byte)
+            packet_data = struct.pack(">QB", timestamp_us, frame_type) + bytes(encoded_packet)
+            packet_ring.put(frame_id, packet_data, frame_type == 1)
+
+async def publish_packets(packet_ring: ShmByteRing, frame_hub: BroadcastHub, show_fps=SHOW_FPS):
+    """
+    Publish the packets of one rendition of the encode worker to the viewers subscribed to it.
+
+    :param show_fps: Print the packet rate, only wanted for one rendition
+    """
+    loop = asyncio.get_event_loop()
+    frame_count = 0
+    prev_time = time.monotonic()
+
+    def get():
+        # Short timeout so the executor thread notices cancellation
+        try:
+            return packet_ring.get(timeout=0.5)
+        except queue.Empty:
+            return None
+
+    while True:
+        try:
+            item = await loop.run_in_executor(None, get)
+
+            if item is None:
+                continue
+
+            frame_id, packet_data = item
+            timestamped_frame = (time.time(), WirePayload(packet_data, frame_id))
+            frame_hub.publish(timestamped_frame, is_keyframe_packet(packet_data))
+
+            if show_fps:
+                frame_count += 1
+                now = time.monotonic()
+                total_time = now - prev_time
+                if total_time >= 1.0:
+                    fps = frame_count / total_time
+                    print(f"FPS: {fps:.2f}")
+                    frame_count = 0
+                    prev_time = now
+        except asyncio.CancelledError:
+            break
+        except QueueStoppedError:
+            break
+        except Exception as e:
+            Log.exception(f"error at publish_packets: {e}")
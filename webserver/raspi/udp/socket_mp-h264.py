@@ -61,10 +61,13 @@ ACK_MARKER    = b'\x05\x06\x7F\xED'
 ACK_FORMAT    = "!4s 3s B"       # | 4-byte marker | 3-byte frame_id | 1-byte chunk_index |
 ACK_SIZE      = struct.calcsize(ACK_FORMAT)
 
+KEYFRAME_MARKER = b'\x07\x08\x7F\xED'  # The server lost a frame and asks for a keyframe
+
 
 class UDPSender(asyncio.DatagramProtocol):
-    def __init__(self, window_size=30, timeout=100):
+    def __init__(self, keyframe_request: multiprocessing.Event, window_size=30, timeout=100):
         self.transport     = None
+        self.keyframe_request = keyframe_request
         self._send_queue   = deque()         # (fid, idx, packet)
         self._pending      = {}              # (fid,idx) -> (packet, last_send_ms)
         self._heap = []     # list of (next_retransmit_time_ms, fid, idx)
@@ -187,6 +190,9 @@ class UDPSender(asyncio.DatagramProtocol):
             if key in self._pending:
                 del self._pending[key]
             #print(f"ACK received: frame={key[0]} chunk={key[1]}")
+        elif data == KEYFRAME_MARKER:
+            # Picked up by encode_video, the next frame becomes an IDR frame
+            self.keyframe_request.set()
         else:
             # any other inbound message
             print(f"Received from {addr}: {data!r}")
@@ -251,15 +257,16 @@ class VideoStream:
         self.running = False
         self.cap.release()
 
-async def encode_video(frame_queue: multiprocessing.Queue, encode_queue: multiprocessing.Queue):
+async def encode_video(frame_queue: multiprocessing.Queue, encode_queue: multiprocessing.Queue, keyframe_request: multiprocessing.Event):
     import av
+    from av.video.frame import PictureType
     encoder = av.CodecContext.create('libx264', 'w')
     encoder.width = 640
     encoder.height = 480
     encoder.pix_fmt = 'yuv420p'
     encoder.bit_rate = 2000000  
     encoder.framerate = 30 
-    encoder.options = {'tune': 'zerolatency'} 
+    encoder.options = {'tune': 'zerolatency', 'forced-idr': '1'}  # forced-idr: frames forced to I become IDR frames
 
     while True:
         try:
@@ -267,6 +274,9 @@ async def encode_video(frame_queue: multiprocessing.Queue, encode_queue: multipr
 
             img_yuv = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
             video_frame = av.VideoFrame.from_ndarray(img_yuv, format='yuv420p')
+            if keyframe_request.is_set():
+                keyframe_request.clear()
+                video_frame.pict_type = PictureType.I
             encoded_packet = encoder.encode(video_frame) 
 
             if len(encoded_packet) == 0:
@@ -335,10 +345,10 @@ async def send_frame(protocol: UDPSender, encoded_frame: bytes):
         print(f"Checksum: {checksum}")
         print(f"End Marker: {END_MARKER}")
         '''
-def async_encode(frame_queue: multiprocessing.Queue, encode_queue: multiprocessing.Queue):
+def async_encode(frame_queue: multiprocessing.Queue, encode_queue: multiprocessing.Queue, keyframe_request: multiprocessing.Event):
     install_loop()
     try:
-        asyncio.run(encode_video(frame_queue, encode_queue))
+        asyncio.run(encode_video(frame_queue, encode_queue, keyframe_request))
     except KeyboardInterrupt:
         print("exiting...")
     except SystemExit:
@@ -363,17 +373,18 @@ async def main():
 
     frame_queue  = multiprocessing.Queue(120)
     encode_queue = multiprocessing.Queue(120)
+    keyframe_request = multiprocessing.Event()
     vs = VideoStream(frame_queue)
     capture_task = asyncio.create_task(vs.start())
 
-    encode_process = multiprocessing.Process(target=async_encode, args=(frame_queue,encode_queue))
+    encode_process = multiprocessing.Process(target=async_encode, args=(frame_queue,encode_queue,keyframe_request))
     encode_process.start()
 
     loop = asyncio.get_running_loop()
 
     # Create UDP Client / Sender endpoint
     transport, protocol = await loop.create_datagram_endpoint(
-        lambda: UDPSender(),
+        lambda: UDPSender(keyframe_request),
         remote_addr=(EC2_UDP_IP, EC2_UDP_PORT)
     )
 